@@ -6,6 +6,7 @@ import sys
 import uuid
 import subprocess
 import functools
+from concurrent.futures import ThreadPoolExecutor
 from dotmap import DotMap
 
 
@@ -19,7 +20,8 @@ from installed_clients.GenericsAPIClient import GenericsAPI
 from .util.kbase_obj import AmpliconMatrix, AttributeMapping
 from .util.dprint import dprint
 from .util.varstash import Var, reset_Var # `Var` holds globals, `reset` clears everything but config stuff
-from .util.workflow import do_AmpliconMatrix_workflow, do_GenomeSet_workflow
+from .util.workflow import do_AmpliconMatrix_workflow, do_GenomeSet_workflow, fetch_AmpliconMatrix, drop_prefetched
+from .util.database import get_db
 from .util.params import Params
 
 
@@ -108,16 +110,37 @@ class kb_faprotax:
         #####
 
 
-        oi = Var.ws.get_object_info3({'objects': [{'ref': params['input_upa']}]})['infos'][0]
+        # Start type lookup, AmpliconMatrix download and database load together,
+        # and join each where it's needed
+        # The AmpliconMatrix download is speculative, and dropped for GenomeSets
+        executor = ThreadPoolExecutor(max_workers=3)
 
-        if oi[2].startswith('KBaseSearch.GenomeSet'):
-            output = do_GenomeSet_workflow()
+        try:
+            oi_future = executor.submit(Var.ws.get_object_info3, {'objects': [{'ref': params['input_upa']}]})
 
-        elif oi[2].startswith('KBaseMatrices.AmpliconMatrix'):
-            output = do_AmpliconMatrix_workflow()
+            Var.update({
+                'prefetch_executor': executor,
+                'prefetch': {
+                    'AmpliconMatrix': (executor.submit(fetch_AmpliconMatrix, params['input_upa']), (params['input_upa'],)),
+                },
+            })
+            if Var.params.getd('faprotax_engine') == 'native':
+                Var.prefetch['db'] = (executor.submit(get_db, Var.db_flpth), (Var.db_flpth,))
 
-        else:
-            raise Exception('Unknown type `%s` for `input_upa`' % oi[2])
+            oi = oi_future.result()['infos'][0]
+
+            if oi[2].startswith('KBaseSearch.GenomeSet'):
+                drop_prefetched('AmpliconMatrix')
+                output = do_GenomeSet_workflow()
+
+            elif oi[2].startswith('KBaseMatrices.AmpliconMatrix'):
+                output = do_AmpliconMatrix_workflow()
+
+            else:
+                raise Exception('Unknown type `%s` for `input_upa`' % oi[2])
+
+        finally:
+            executor.shutdown(wait=True) # nothing left running on success, don't outlive `Var` on failure
 
 
 
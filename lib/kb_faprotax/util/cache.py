@@ -0,0 +1,106 @@
+import logging
+import sqlite3
+import time
+
+from .dprint import dprint
+
+'''
+On-disk taxonomy -> FAPROTAX groups memo, shared across runs
+
+Users rerun FAPROTAX on matrices classified against the same reference,
+so the same taxonomy strings recur. Entries are keyed by the compiled database hash,
+so a database change never serves stale groups
+'''
+
+
+
+####################################################################################################
+####################################################################################################
+def normalize_taxonomy(taxonomy) -> str:
+    '''
+    Member patterns match case-insensitively, so case never changes the groups
+    '''
+    return taxonomy.lower()
+
+
+####################################################################################################
+####################################################################################################
+class TaxonomyCache:
+    '''
+    sqlite key/value store with least-recently-used eviction past `max_entries`
+    '''
+
+    CHUNK = 500 # stay under sqlite's bound-variable limit
+
+    def __init__(self, flpth, max_entries=1000000):
+        self.flpth = flpth
+        self.max_entries = max_entries
+
+        self.conn = sqlite3.connect(flpth, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS memo ('
+            'db_hash TEXT, taxonomy TEXT, groups TEXT, last_used REAL, '
+            'PRIMARY KEY (db_hash, taxonomy))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS memo_last_used ON memo (last_used)')
+        self.conn.commit()
+
+    def get_many(self, db_hash, taxonomies) -> dict:
+        '''
+        Return dict of the cached `taxonomies` -> list of group names,
+        marking them as recently used
+        '''
+        key2taxonomies = {}
+        for taxonomy in taxonomies:
+            key2taxonomies.setdefault(normalize_taxonomy(taxonomy), []).append(taxonomy)
+        keys = list(key2taxonomies)
+        found = {}
+
+        for i in range(0, len(keys), self.CHUNK):
+            chunk = keys[i:i + self.CHUNK]
+            rows = self.conn.execute(
+                'SELECT taxonomy, groups FROM memo WHERE db_hash = ? AND taxonomy IN (%s)'
+                % ','.join('?' * len(chunk)),
+                [db_hash] + chunk
+            ).fetchall()
+            for key, groups in rows:
+                for taxonomy in key2taxonomies[key]:
+                    found[taxonomy] = groups.split(',') if groups else []
+
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                'UPDATE memo SET last_used = ? WHERE db_hash = ? AND taxonomy = ?',
+                [(now, db_hash, key) for key in {normalize_taxonomy(taxonomy) for taxonomy in found}]
+            )
+            self.conn.commit()
+
+        return found
+
+    def put_many(self, db_hash, taxonomy2groups: dict):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)',
+            [
+                (db_hash, normalize_taxonomy(taxonomy), ','.join(groups), now)
+                for taxonomy, groups in taxonomy2groups.items()
+            ]
+        )
+        self.conn.commit()
+        self._evict()
+
+    def _evict(self):
+        num = self.conn.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+        if num > self.max_entries:
+            logging.info('Evicting %d least recently used entries from `%s`' % (num - self.max_entries, self.flpth))
+            self.conn.execute(
+                'DELETE FROM memo WHERE rowid IN (SELECT rowid FROM memo ORDER BY last_used LIMIT ?)',
+                (num - self.max_entries,)
+            )
+            self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,369 @@
+import logging
+import os
+import sys
+import hashlib
+import pickle
+import numpy as np
+
+from .dprint import dprint
+from .error import *
+
+'''
+Compiled FAPROTAX.txt
+
+Parsing the text database is paid once per deployment:
+the compiled form is pickled next to the text file, keyed by the text file's content hash,
+and rebuilt whenever that hash changes
+'''
+
+
+
+####################################################################################################
+####################################################################################################
+OPS = ['add_group', 'subtract_group', 'intersect_group']
+
+FORMAT_VERSION = 3 # bump when the compiled layout changes
+
+
+def parse_groups_file(flpth) -> list:
+    '''
+    Parse FAPROTAX.txt format into list of groups, in file order
+    Each group is a dict with keys
+    * name
+    * metadata - the raw metadata string following the group name
+    * ops - ordered list of `(op, arg)`, where `op` is `'member'` or one of `OPS`
+
+    Pure comment lines are skipped, and do not separate groups
+    Groups are separated by blank or pure-whitespace lines
+    '''
+    groups = []
+    group = None
+
+    with open(flpth) as fh:
+        for line in fh:
+            stripped = line.strip()
+
+            if stripped == '':
+                group = None
+                continue
+            if stripped.startswith('#'):
+                continue
+
+            # strip trailing comment, quotes
+            if stripped.startswith('"'):
+                entry = stripped[1:].split('"')[0]
+            else:
+                entry = stripped.split('#')[0].strip()
+
+            if group is None: # header
+                name, *metadata = entry.split(None, 1)
+                group = {'name': name, 'metadata': metadata[0] if metadata else '', 'ops': []}
+                groups.append(group)
+                continue
+
+            op, sep, arg = entry.partition(':')
+            if sep and op in OPS:
+                group['ops'].append((op, arg.strip()))
+            else:
+                group['ops'].append(('member', entry))
+
+    # set operations can only reference previously defined groups
+    seen = set()
+    for group in groups:
+        for op, arg in group['ops']:
+            if op in OPS and arg not in seen:
+                raise DatabaseParseException(
+                    'Group `%s` references group `%s` before it is defined in `%s`'
+                    % (group['name'], arg, flpth)
+                )
+        seen.add(group['name'])
+
+    return groups
+
+
+def parse_metadata(metadata) -> dict:
+    '''
+    `'elements:C,H; aerobic:no'` -> `{'elements': ['C', 'H'], 'aerobic': ['no']}`
+    '''
+    parsed = {}
+    for entry in metadata.split(';'):
+        key, sep, values = entry.partition(':')
+        if not sep:
+            continue
+        parsed[sys.intern(key.strip())] = [sys.intern(value.strip()) for value in values.split(',') if value.strip()]
+    return parsed
+
+
+def compile_program(group_ops) -> list:
+    '''
+    Merge runs of consecutive member ops into one `('members', pattern_inds)` step,
+    so they resolve with a single vectorized OR. Set ops stay in place, since order matters
+    '''
+    program = []
+    for op, ind in group_ops:
+        if op == 'member':
+            if program and program[-1][0] == 'members':
+                program[-1][1].append(ind)
+            else:
+                program.append(('members', [ind]))
+        else:
+            program.append((op, ind))
+
+    return [(op, np.array(arg, dtype=np.intp) if op == 'members' else arg) for op, arg in program]
+
+
+def get_hash(flpth):
+    with open(flpth, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+####################################################################################################
+####################################################################################################
+class FaprotaxDB:
+    '''
+    Instance variables:
+    * hash - sha256 of the text database
+    * group_names - in file order
+    * metadata - parsed metadata dict per group
+    * metadata_raw - raw metadata string per group
+    * patterns - unique member patterns, as written
+    * tokens - unique lowercased `*`-separated pattern tokens
+    * pattern_tokens - per pattern, tuple of token indices. Empty leading/trailing token means unanchored
+    * ops - per group, ordered list of `(op, ind)`, where `ind` indexes
+      `patterns` for `'member'` ops and `group_names` for set ops
+    * deps - per group, indices of groups its set ops reference.
+      Groups only reference earlier groups, so file order is a topological order of this DAG
+    * programs - per group, `ops` compiled by `compile_program`
+    * metadata_index - metadata key -> value -> indices of groups with that value
+    '''
+
+    def __init__(self, state):
+        self.__dict__.update(state)
+
+    @classmethod
+    def compile(cls, flpth, hash=None):
+        logging.info('Compiling FAPROTAX database `%s`' % flpth)
+
+        groups = parse_groups_file(flpth)
+
+        group_names = [sys.intern(group['name']) for group in groups]
+        name2ind = {name: i for i, name in enumerate(group_names)}
+
+        patterns = []
+        pattern2ind = {}
+        tokens = []
+        token2ind = {}
+        pattern_tokens = []
+        ops = []
+
+        for group in groups:
+            group_ops = []
+            for op, arg in group['ops']:
+                if op != 'member':
+                    group_ops.append((op, name2ind[arg]))
+                    continue
+                if arg not in pattern2ind:
+                    pattern2ind[arg] = len(patterns)
+                    patterns.append(arg)
+                    token_inds = []
+                    for token in arg.lower().split('*'):
+                        if token not in token2ind:
+                            token2ind[token] = len(tokens)
+                            tokens.append(sys.intern(token))
+                        token_inds.append(token2ind[token])
+                    pattern_tokens.append(tuple(token_inds))
+                group_ops.append((op, pattern2ind[arg]))
+            ops.append(group_ops)
+
+        metadata = [parse_metadata(group['metadata']) for group in groups]
+        metadata_index = {}
+        for i, group_metadata in enumerate(metadata):
+            for key, values in group_metadata.items():
+                for value in values:
+                    metadata_index.setdefault(key, {}).setdefault(value, []).append(i)
+
+        return cls({
+            'format_version': FORMAT_VERSION,
+            'hash': get_hash(flpth) if hash is None else hash,
+            'group_names': group_names,
+            'metadata': metadata,
+            'metadata_raw': [group['metadata'] for group in groups],
+            'patterns': patterns,
+            'tokens': tokens,
+            'pattern_tokens': pattern_tokens,
+            'ops': ops,
+            'deps': [sorted({ind for op, ind in group_ops if op != 'member'}) for group_ops in ops],
+            'programs': [compile_program(group_ops) for group_ops in ops],
+            'metadata_index': metadata_index,
+        })
+
+    @property
+    def num_groups(self):
+        return len(self.group_names)
+
+    def select_groups(self, predicate: dict) -> list:
+        '''
+        Indices of groups whose metadata satisfies `predicate`, ascending
+        `predicate` maps metadata key to a value or list of values.
+        A group must have at least one of the values for every key,
+        e.g. `{'elements': 'N'}` or `{'elements': ['N', 'S'], 'aerobic': 'no'}`
+        '''
+        selected = set(range(self.num_groups))
+        for key, values in predicate.items():
+            values = [values] if isinstance(values, str) else values
+            value2inds = self.metadata_index.get(key, {})
+            selected &= {i for value in values for i in value2inds.get(value, [])}
+        return sorted(selected)
+
+    def get_closure(self, group_inds) -> list:
+        '''
+        `group_inds` plus every group they depend on through set ops, ascending
+        '''
+        closure = set()
+        stack = list(group_inds)
+        while stack:
+            i = stack.pop()
+            if i not in closure:
+                closure.add(i)
+                stack.extend(self.deps[i])
+        return sorted(closure)
+
+    def get_patterns(self, group_inds) -> list:
+        '''
+        Indices of member patterns used directly by `group_inds`, ascending
+        '''
+        return sorted({ind for i in group_inds for op, ind in self.ops[i] if op == 'member'})
+
+    def resolve(self, pattern_inds, record_inds, num_records, groups=None) -> np.ndarray:
+        '''
+        Input:
+        * pattern_inds, record_inds - coordinates of (member pattern, record) hits
+        * num_records
+        * groups - restrict resolving to these group indices, which must be closed under `deps`.
+          Bitsets of other groups are left empty
+
+        Output:
+        * groups x words packed membership bitsets, see `pack_bits`
+
+        Groups are resolved in file order, running each group's program
+        over the bitsets of its patterns and of the groups it depends on
+        '''
+        pattern_inds = np.asarray(pattern_inds, dtype=np.intp)
+        record_inds = np.asarray(record_inds, dtype=np.intp)
+        num_words = get_num_words(num_records)
+
+        # only patterns with hits get a bitset
+        hit_patterns, rows = np.unique(pattern_inds, return_inverse=True)
+        hits = np.zeros((len(hit_patterns), num_words), dtype=np.uint64)
+        np.bitwise_or.at(
+            hits,
+            (rows, record_inds >> 6),
+            np.left_shift(np.uint64(1), (record_inds & 63).astype(np.uint64))
+        )
+        pattern2row = np.full(len(self.patterns), -1, dtype=np.intp)
+        pattern2row[hit_patterns] = np.arange(len(hit_patterns))
+
+        bits = np.zeros((self.num_groups, num_words), dtype=np.uint64)
+
+        for i in range(self.num_groups) if groups is None else sorted(groups):
+            row = bits[i]
+            program = self.programs[i]
+            for op, arg in program:
+                if op == 'members':
+                    hit_rows = pattern2row[arg]
+                    hit_rows = hit_rows[hit_rows >= 0]
+                    if len(hit_rows) > 0:
+                        row |= np.bitwise_or.reduce(hits[hit_rows], axis=0)
+                elif op == 'add_group':
+                    row |= bits[arg]
+                elif op == 'subtract_group':
+                    row &= ~bits[arg]
+                elif op == 'intersect_group':
+                    row &= bits[arg]
+
+        return bits
+
+    def get_definition(self, i) -> str:
+        '''
+        Group `i` in FAPROTAX.txt format, without comments
+        '''
+        lines = ['%s\t%s' % (self.group_names[i], self.metadata_raw[i])]
+        for op, ind in self.ops[i]:
+            lines.append(self.patterns[ind] if op == 'member' else '%s:%s' % (op, self.group_names[ind]))
+        return '\n'.join(lines) + '\n'
+
+
+####################################################################################################
+####################################################################################################
+def get_num_words(num_records):
+    return (num_records + 63) // 64
+
+
+def pack_bits(a: np.ndarray) -> np.ndarray:
+    '''
+    Boolean rows x records -> uint64 rows x words, record `j` at bit `j % 64` of word `j // 64`
+    '''
+    a = np.asarray(a, dtype=bool)
+    num_words = get_num_words(a.shape[1])
+    packed = np.packbits(a, axis=1, bitorder='little')
+    padded = np.zeros((a.shape[0], num_words * 8), dtype=np.uint8)
+    padded[:, :packed.shape[1]] = packed
+    return padded.view('<u8').astype(np.uint64)
+
+
+def unpack_bits(bits: np.ndarray, num_records) -> np.ndarray:
+    '''
+    Inverse of `pack_bits`
+    '''
+    return np.unpackbits(
+        np.ascontiguousarray(bits, dtype='<u8').view(np.uint8), axis=1, count=num_records, bitorder='little'
+    ).astype(bool)
+
+
+####################################################################################################
+####################################################################################################
+_dbs = {} # text database filepath -> FaprotaxDB, for this process
+
+
+def get_compiled_flpth(flpth):
+    return os.path.splitext(flpth)[0] + '.compiled.pkl'
+
+
+def load_db(flpth) -> FaprotaxDB:
+    '''
+    Load the compiled database for text database `flpth`,
+    compiling and storing it next to `flpth` if missing or stale
+    '''
+    hash = get_hash(flpth)
+    compiled_flpth = get_compiled_flpth(flpth)
+
+    if os.path.exists(compiled_flpth):
+        try:
+            with open(compiled_flpth, 'rb') as fh:
+                state = pickle.load(fh)
+            if state.get('hash') == hash and state.get('format_version') == FORMAT_VERSION:
+                return FaprotaxDB(state)
+        except Exception as e:
+            logging.warning('Could not load compiled FAPROTAX database `%s`: %s' % (compiled_flpth, e))
+
+    db = FaprotaxDB.compile(flpth, hash=hash)
+
+    # write atomically so concurrent jobs never see a partial file
+    try:
+        tmp_flpth = '%s.%d.tmp' % (compiled_flpth, os.getpid())
+        with open(tmp_flpth, 'wb') as fh:
+            pickle.dump(db.__dict__, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_flpth, compiled_flpth)
+    except OSError as e:
+        logging.warning('Could not store compiled FAPROTAX database `%s`: %s' % (compiled_flpth, e))
+
+    return db
+
+
+def get_db(flpth) -> FaprotaxDB:
+    '''
+    Lazily load, once per process
+    '''
+    if flpth not in _dbs:
+        _dbs[flpth] = load_db(flpth)
+    return _dbs[flpth]
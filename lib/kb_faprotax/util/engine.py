@@ -0,0 +1,628 @@
+import logging
+import os
+import io
+import gzip
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from scipy import sparse
+import scipy.io
+
+from .dprint import dprint
+from .varstash import Var
+from .error import *
+from .database import FaprotaxDB, get_db, unpack_bits
+from .matcher import get_matcher
+from .cache import TaxonomyCache
+
+'''
+In-process FAPROTAX
+
+Does what `collapse_table.py` does for the options used by the workflows,
+without starting a Python 2.7 interpreter or round tripping TSVs
+
+In FAPROTAX, a taxonomic path is also known as a 'record', and a
+function is also known as a 'group'
+'''
+
+
+
+####################################################################################################
+####################################################################################################
+def factorize_records(records) -> tuple:
+    '''
+    Many rows share a taxonomy (e.g., genus-level assignments),
+    so match each distinct record once and broadcast back with `inverse`
+
+    Output:
+    * uniq_l - distinct records, in order of first appearance. Missing taxonomy becomes `''`
+    * inverse - for each record, index into `uniq_l`
+    '''
+    records = np.array([record if isinstance(record, str) else '' for record in records], dtype=object)
+    inverse, uniq = pd.factorize(records)
+    return uniq.tolist(), inverse
+
+
+####################################################################################################
+####################################################################################################
+def assign_groups(db: FaprotaxDB, records, cache: TaxonomyCache = None, groups=None,
+                  num_workers=1, min_shard_records=10000, db_flpth=None) -> np.ndarray:
+    '''
+    Return boolean membership array, groups x records
+
+    Group operations are applied in order, so e.g. `subtract_group:`
+    only removes from what was accumulated up to that point.
+    They are resolved over packed bitsets, see `FaprotaxDB.resolve`
+
+    Records found in `cache` skip matching entirely, and newly matched records are added to it
+
+    If `groups` is given, only those groups and the groups they depend on are matched and resolved.
+    Rows of other groups are not meaningful
+
+    Records not in `cache` are matched across up to `num_workers` processes,
+    in contiguous shards of at least `min_shard_records`. Only this process reads and writes `cache`.
+    Pass distinct records (see `factorize_records`), so no record is matched twice
+    '''
+    membership = np.zeros((db.num_groups, len(records)), dtype=bool)
+    needed = None if groups is None else db.get_closure(groups)
+
+    cached = cache.get_many(db.hash, records) if cache is not None else {}
+    todo = [j for j, record in enumerate(records) if record not in cached]
+
+    if cached:
+        logging.info('Found %d of %d taxonomies in memo cache' % (len(cached), len(records)))
+        name2ind = {name: i for i, name in enumerate(db.group_names)}
+        for j, record in enumerate(records):
+            if record in cached:
+                membership[[name2ind[name] for name in cached[record]], j] = True
+
+    if todo:
+        todo_records = [records[j] for j in todo]
+        num_shards = min(num_workers, len(todo_records) // min_shard_records)
+
+        if num_shards <= 1:
+            membership[:, todo] = _match_records(db, todo_records, needed)
+
+        else:
+            logging.info('Sharding %d distinct taxonomies across %d processes' % (len(todo_records), num_shards))
+
+            # build matcher before forking so workers inherit it
+            get_matcher(db, None if needed is None else db.get_patterns(needed))
+
+            bounds = np.linspace(0, len(todo_records), num_shards + 1).astype(int)
+            # fork so workers inherit the matcher. Only safe with no other threads running,
+            # which is why `run_native` stops the prefetch pool first
+            mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+            with ProcessPoolExecutor(max_workers=num_shards, mp_context=mp_context) as executor:
+                futures = [
+                    executor.submit(
+                        _match_records_worker, Var.db_flpth if db_flpth is None else db_flpth,
+                        todo_records[start:stop], needed)
+                    for start, stop in zip(bounds[:-1], bounds[1:])
+                ]
+                membership[:, todo] = np.hstack([future.result() for future in futures])
+
+        if cache is not None and needed is None: # only complete group lists are memoized
+            cache.put_many(db.hash, {
+                record: [db.group_names[i] for i in np.flatnonzero(membership[:, j])]
+                for j, record in zip(todo, todo_records)
+            })
+
+    return membership
+
+
+def _match_records(db: FaprotaxDB, records, needed) -> np.ndarray:
+    '''
+    Match and resolve `records`, without the memo cache. Return boolean groups x records
+    '''
+    matcher = get_matcher(db, None if needed is None else db.get_patterns(needed))
+    pattern_inds, record_inds = matcher.match_patterns_many(records)
+    bits = db.resolve(pattern_inds, record_inds, len(records), groups=needed)
+    return unpack_bits(bits, len(records))
+
+
+def _match_records_worker(db_flpth, records, needed) -> np.ndarray:
+    '''
+    `_match_records` in a worker process
+    '''
+    return _match_records(get_db(db_flpth), records, needed)
+
+
+####################################################################################################
+####################################################################################################
+def build_membership(membership_uniq, inverse) -> sparse.csr_matrix:
+    '''
+    Broadcast groups x distinct records membership to sparse groups x records
+    '''
+    n = len(inverse)
+    broadcast = sparse.csr_matrix(
+        (np.ones(n, dtype=np.int8), (inverse, np.arange(n))),
+        shape=(membership_uniq.shape[1], n)
+    )
+    return (sparse.csr_matrix(membership_uniq, dtype=np.int8) @ broadcast).tocsr()
+
+
+def collapse(membership: sparse.csr_matrix, data, dtype=np.float64, block_size=None) -> np.ndarray:
+    '''
+    groups x samples = (groups x records membership) . (records x samples abundances)
+    `dtype=np.float32` halves memory and accumulates in single precision
+
+    With `block_size`, samples go through in column blocks of that size against the same membership,
+    so the `dtype`/NaN-free temporaries are one block, not a whole copy of `data`
+    `data` itself is still held whole by the caller, which sets peak memory
+    '''
+    membership = membership.astype(dtype)
+    data = np.asarray(data)
+
+    if block_size is None or data.shape[1] <= block_size:
+        return np.asarray(membership @ np.nan_to_num(np.asarray(data, dtype=dtype)))
+
+    collapsed = np.empty((membership.shape[0], data.shape[1]), dtype=dtype)
+    for start in range(0, data.shape[1], block_size):
+        stop = start + block_size
+        collapsed[:, start:stop] = membership @ np.nan_to_num(np.asarray(data[:, start:stop], dtype=dtype))
+
+    return collapsed
+
+
+####################################################################################################
+####################################################################################################
+class FaprotaxResult:
+    '''
+    FAPROTAX results in memory, produced once by `collapse_table`
+    or parsed once from `collapse_table.py` outputs by `from_outputs`,
+    for downstream steps to consume without going back to disk
+
+    Instance variables created during init:
+    * records - taxonomy per record, in input order
+    * group_names
+    * membership - groups x records 0/1 sparse CSR
+    * collapsed_df - groups x samples
+    '''
+
+    def __init__(self, records, group_names, membership: sparse.csr_matrix, collapsed_df):
+        self.records = records
+        self.group_names = group_names
+        self.membership = sparse.csr_matrix(membership, dtype=np.int8)
+        self.collapsed_df = collapsed_df
+
+    @classmethod
+    def from_outputs(cls, collapsed_flpth, groups2records_flpth):
+        '''
+        Parse `collapse_table.py`'s collapsed table and groups2records table,
+        the only two outputs that carry everything downstream needs
+        '''
+        collapsed_df = pd.read_csv(collapsed_flpth, sep='\t', comment='#', index_col=0)
+        collapsed_df.index.name = 'group'
+
+        g2r_df = pd.read_csv(groups2records_flpth, sep='\t', comment='#')
+        records = g2r_df['record'].fillna('').tolist()
+        group_names = g2r_df.columns.tolist()[1:]
+        membership = sparse.csr_matrix(g2r_df[group_names].fillna(0).values.T != 0, dtype=np.int8)
+
+        return cls(records, group_names, membership, collapsed_df)
+
+    @property
+    def num_records(self):
+        return len(self.records)
+
+    @property
+    def num_groups(self):
+        return len(self.group_names)
+
+    def get_groups_l(self, dlm=',') -> list:
+        '''
+        For each record, `dlm`-joined groups it was assigned to, in group order
+        Same as the `group` column of groups2records_dense.tsv
+        '''
+        csc = self.membership.tocsc()
+        csc.sort_indices()
+        group_names = np.array(self.group_names, dtype=object)
+        return [
+            dlm.join(group_names[csc.indices[csc.indptr[j]:csc.indptr[j + 1]]])
+            for j in range(self.num_records)
+        ]
+
+    def get_tax2groups(self, dlm=',') -> dict:
+        '''
+        Map from taxonomy to `dlm`-joined groups
+        '''
+        return dict(zip(self.records, self.get_groups_l(dlm)))
+
+    def iter_membership_tsv(self, row_ids=None, index_name='record', chunk_size=10000):
+        '''
+        Yield records x groups 0/1 membership as TSV text, header first,
+        then in blocks of `chunk_size` records labeled by `row_ids` (default the records)
+        Only one dense block exists at a time, so memory is flat in the number of records
+        '''
+        row_ids = self.records if row_ids is None else row_ids
+        by_record = self.membership.T.tocsr() # cheap row slices
+        digits = np.array(['0', '1'], dtype=object)
+
+        buf = io.StringIO() # reused across blocks
+
+        yield '\t'.join([index_name] + list(self.group_names)) + '\n'
+
+        for start in range(0, self.num_records, chunk_size):
+            stop = start + chunk_size
+            block = digits[(by_record[start:stop].toarray() != 0).astype(np.intp)]
+
+            buf.seek(0)
+            buf.truncate()
+            for row_id, row in zip(row_ids[start:stop], block.tolist()):
+                buf.write('\t'.join(['' if row_id is None else str(row_id)] + row))
+                buf.write('\n')
+
+            yield buf.getvalue()
+
+    def write_membership_tsv(self, flpth, row_ids=None, index_name='record', chunk_size=10000):
+        '''
+        Stream `iter_membership_tsv` to `flpth`
+        '''
+        with open(flpth, 'w') as fh:
+            for block in self.iter_membership_tsv(row_ids, index_name=index_name, chunk_size=chunk_size):
+                fh.write(block)
+
+    def get_membership_tsv_size(self, row_ids=None, index_name='record') -> int:
+        '''
+        Bytes `write_membership_tsv` would write, without writing it
+        '''
+        row_ids = self.records if row_ids is None else row_ids
+        header = '\t'.join([index_name] + list(self.group_names)) + '\n'
+        labels_size = sum(len(('' if row_id is None else str(row_id)).encode()) for row_id in row_ids)
+        return len(header.encode()) + labels_size + len(row_ids) * (2 * self.num_groups + 1) # `\t0` or `\t1` per group
+
+    def get_g2r_df(self) -> pd.DataFrame:
+        '''
+        Records x groups 0/1 membership, column `record` first. Dense, for writing/testing
+        '''
+        g2r_df = pd.DataFrame(self.membership.T.toarray(), columns=self.group_names)
+        g2r_df.insert(0, 'record', self.records)
+        return g2r_df
+
+
+####################################################################################################
+####################################################################################################
+def get_cgroup_cpu_quota(cgroup_dir='/sys/fs/cgroup'):
+    '''
+    CPUs allowed by the container's cgroup CPU quota, e.g. Docker `--cpus`, as a float
+    Reads cgroup v2 `cpu.max`, else cgroup v1 `cpu.cfs_quota_us`/`cpu.cfs_period_us`
+    Return None if there is no quota or it can't be read
+    '''
+    try:
+        with open(os.path.join(cgroup_dir, 'cpu.max')) as fh:
+            quota, period = fh.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    for cpu_dir in ['cpu', 'cpu,cpuacct']:
+        try:
+            with open(os.path.join(cgroup_dir, cpu_dir, 'cpu.cfs_quota_us')) as fh:
+                quota = int(fh.read())
+            with open(os.path.join(cgroup_dir, cpu_dir, 'cpu.cfs_period_us')) as fh:
+                period = int(fh.read())
+        except (OSError, ValueError):
+            continue
+        if quota <= 0 or period <= 0: # -1 is no quota
+            return None
+        return quota / period
+
+    return None
+
+
+def get_num_workers():
+    '''
+    CPUs this process may run on, capped by the cgroup CPU quota,
+    since containers limited by a quota still see all the host's CPUs in their affinity
+    '''
+    try:
+        num_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cpus = os.cpu_count() or 1
+
+    quota = get_cgroup_cpu_quota()
+    if quota is not None:
+        num_cpus = min(num_cpus, max(1, int(quota)))
+
+    return num_cpus
+
+
+####################################################################################################
+####################################################################################################
+def collapse_table(tax_l, data, col_ids, db_flpth=None, dtype=np.float64, cache=None, group_filter=None,
+                   num_workers=1, min_shard_records=10000, sample_block_size=None) -> FaprotaxResult:
+    '''
+    Input:
+    * tax_l - records, one per row of `data`
+    * data - records x samples abundances. Missing values count as 0
+    * col_ids - sample names
+    * dtype - accumulation dtype for collapsing
+    * cache - optional `TaxonomyCache` consulted before matching
+    * group_filter - optional metadata predicate restricting the run to some groups,
+      see `FaprotaxDB.select_groups`
+    * num_workers - processes to shard matching across. Shards have at least `min_shard_records` distinct taxonomies
+    * sample_block_size - collapse this many samples at a time, for very wide matrices. See `collapse`
+
+    Output:
+    * `FaprotaxResult`. Its `collapsed_df` has summed abundances of each group's records,
+      for only groups selected by `group_filter`, if given
+
+    Taxonomies are deduplicated once, and only the distinct ones not in `cache` are sharded for matching,
+    see `assign_groups`. The collapse product is one sparse product in this process
+    '''
+    db_flpth = Var.db_flpth if db_flpth is None else db_flpth
+
+    logging.info('Running FAPROTAX in-process on %d records with database `%s`' % (len(tax_l), db_flpth))
+
+    db = get_db(db_flpth)
+
+    if group_filter is None:
+        groups = None
+        selected = list(range(db.num_groups))
+    else:
+        groups = selected = db.select_groups(group_filter)
+        if not selected:
+            raise ValidationException('No FAPROTAX groups have metadata matching `%s`' % group_filter)
+        logging.info('Restricting run to %d groups matching `%s`' % (len(selected), group_filter))
+
+    group_names = [db.group_names[i] for i in selected]
+
+    data = np.asarray(data).reshape(len(tax_l), len(col_ids)) # no copy. Converted to `dtype` in `collapse`
+
+    uniq_l, inverse = factorize_records(tax_l)
+    logging.info('Matching %d distinct taxonomies' % len(uniq_l))
+
+    membership_uniq = assign_groups(
+        db, uniq_l, cache=cache, groups=groups,
+        num_workers=num_workers, min_shard_records=min_shard_records, db_flpth=db_flpth)[selected]
+    membership = build_membership(membership_uniq, inverse)
+
+    collapsed = collapse(membership, data, dtype=dtype, block_size=sample_block_size)
+
+    collapsed_df = pd.DataFrame(collapsed, index=group_names, columns=col_ids)
+    collapsed_df.index.name = 'group'
+
+    return FaprotaxResult(tax_l, group_names, membership, collapsed_df)
+
+
+####################################################################################################
+####################################################################################################
+def group_overlaps(membership: sparse.csr_matrix, abundance, group_names) -> tuple:
+    '''
+    Input:
+    * membership - groups x records
+    * abundance - per-record total abundance
+    * group_names
+
+    Output:
+    * overlaps_df - groups x groups, number of records shared, i.e. M . M^T
+    * weighted_overlaps_df - groups x groups, abundance shared, i.e. M . diag(abundance) . M^T
+
+    Both come out of one sparse product of the stacked `[M; M . diag(abundance)]` with M^T
+    '''
+    membership = sparse.csr_matrix(membership, dtype=float)
+    weighted = membership.multiply(np.nan_to_num(np.asarray(abundance, dtype=float))[None, :]).tocsr()
+
+    gram = (sparse.vstack([membership, weighted]).tocsr() @ membership.T).toarray()
+    num_groups = len(group_names)
+
+    overlaps_df = pd.DataFrame(gram[:num_groups].round().astype(int), index=group_names, columns=group_names)
+    weighted_overlaps_df = pd.DataFrame(gram[num_groups:], index=group_names, columns=group_names)
+    overlaps_df.index.name = weighted_overlaps_df.index.name = 'group'
+
+    return overlaps_df, weighted_overlaps_df
+
+
+####################################################################################################
+####################################################################################################
+class OutputWriter:
+    '''
+    Writes FAPROTAX output artifacts to `out_dir`, each only when requested,
+    so skipped artifacts can still be produced later from the same run
+
+    Instance variables created during init:
+    * out_dir
+    * result - `FaprotaxResult`
+    * written - artifact -> filepath, for artifacts written so far
+    '''
+
+    ARTIFACTS = { # artifact -> file/dir name
+        # same names and formats as `collapse_table.py`, checked against its outputs
+        'collapsed_func_table': 'collapsed_func_table.tsv',
+        'groups2records': 'groups2records.tsv',
+        'groups2records_dense': 'groups2records_dense.tsv',
+        # formats of this engine's own, so named apart from `collapse_table.py`'s
+        'sub_tables': 'native_sub_tables',
+        'group_overlaps': 'native_group_overlaps.tsv',
+        'group_overlaps_weighted': 'native_group_overlaps_weighted.tsv',
+        'group_definitions_used': 'native_group_definitions_used.txt',
+        'report': 'native_report.txt',
+    }
+    REQUIRED = ['collapsed_func_table'] # imported as the sample FunctionalProfile
+
+    def __init__(self, out_dir, result: FaprotaxResult, data, db_flpth=None):
+        self.out_dir = out_dir
+        self.result = result
+        self.data = data
+        self.db_flpth = Var.db_flpth if db_flpth is None else db_flpth
+
+        self.tax_l = result.records
+        self.group_names = result.group_names
+        self.col_ids = result.collapsed_df.columns.tolist()
+        self.membership = result.membership
+        self.written = {}
+        self._overlaps = None
+
+    def get_overlaps(self) -> tuple:
+        '''
+        `(overlaps_df, weighted_overlaps_df)`, see `group_overlaps`
+        '''
+        if self._overlaps is None:
+            abundance = np.nansum(
+                np.asarray(self.data, dtype=float).reshape(len(self.tax_l), len(self.col_ids)), axis=1)
+            self._overlaps = group_overlaps(self.membership, abundance, self.group_names)
+        return self._overlaps
+
+    def write(self, artifacts=None):
+        '''
+        Write `artifacts` (default all) plus `REQUIRED`, skipping ones already written
+        '''
+        artifacts = list(self.ARTIFACTS) if artifacts is None else self.REQUIRED + list(artifacts)
+        for artifact in artifacts:
+            self.get_flpth(artifact)
+
+    def get_flpth(self, artifact):
+        '''
+        Filepath of `artifact`, writing it first if necessary
+        '''
+        if artifact not in self.written:
+            flpth = os.path.join(self.out_dir, self.ARTIFACTS[artifact])
+            getattr(self, '_write_' + artifact)(flpth)
+            self.written[artifact] = flpth
+        return self.written[artifact]
+
+    def _write_collapsed_func_table(self, flpth):
+        self.result.collapsed_df.to_csv(flpth, sep='\t')
+
+    def _write_groups2records(self, flpth):
+        self.result.write_membership_tsv(flpth)
+
+    def _write_groups2records_dense(self, flpth):
+        pd.DataFrame({'record': self.tax_l, 'group': self.result.get_groups_l()}).to_csv(flpth, sep='\t', index=False)
+
+    def _write_sub_tables(self, sub_tables_dir):
+        os.makedirs(sub_tables_dir, exist_ok=True)
+        data = np.asarray(self.data, dtype=float).reshape(len(self.tax_l), len(self.col_ids))
+        tax_a = np.array(self.tax_l, dtype=object)
+
+        for i, group in enumerate(self.group_names):
+            rows = self.membership.indices[self.membership.indptr[i]:self.membership.indptr[i + 1]]
+            if len(rows) == 0:
+                continue
+            rows = np.sort(rows)
+            sub_df = pd.DataFrame(data[rows], index=tax_a[rows], columns=self.col_ids)
+            sub_df.index.name = 'record'
+            sub_df.to_csv(os.path.join(sub_tables_dir, group + '.tsv'), sep='\t')
+
+    def _write_group_overlaps(self, flpth):
+        self.get_overlaps()[0].to_csv(flpth, sep='\t')
+
+    def _write_group_overlaps_weighted(self, flpth):
+        self.get_overlaps()[1].to_csv(flpth, sep='\t')
+
+    def _write_group_definitions_used(self, flpth):
+        db = get_db(self.db_flpth)
+        name2ind = {name: i for i, name in enumerate(db.group_names)}
+        with open(flpth, 'w') as fh:
+            for group in self.group_names:
+                fh.write(db.get_definition(name2ind[group]) + '\n')
+
+    def _write_report(self, flpth):
+        num_assigned = int((self.membership.getnnz(axis=0) > 0).sum())
+        num_group_records = self.membership.getnnz(axis=1)
+        with open(flpth, 'w') as fh:
+            fh.write('# In-process FAPROTAX engine, database `%s`\n' % self.db_flpth)
+            fh.write('# Collapsed %d records into %d groups\n' % (len(self.tax_l), len(self.group_names)))
+            fh.write('# %d records were assigned to at least one group\n' % num_assigned)
+            for i, group in enumerate(self.group_names):
+                fh.write('%s\t%d records\n' % (group, num_group_records[i]))
+
+
+def write_outputs(out_dir, result: FaprotaxResult, data, db_flpth=None, artifacts=None) -> OutputWriter:
+    '''
+    Write the files `collapse_table.py` writes, see `OutputWriter.ARTIFACTS` for names
+    Only `artifacts` (default all) and the required ones are written now.
+    Use the returned `OutputWriter` to write others later
+    '''
+    writer = OutputWriter(out_dir, result, data, db_flpth=db_flpth)
+    writer.write(artifacts)
+    return writer
+
+
+####################################################################################################
+####################################################################################################
+def write_parquet_outputs(out_dir, result: FaprotaxResult, data, row_ids=None, compression='zstd') -> list:
+    '''
+    Write compressed columnar (Parquet) versions of the big TSV outputs to `out_dir`
+    * otu_table.parquet - `taxonomy`, `OTU_Id`, then samples. Only if `row_ids` given
+    * collapsed_func_table.parquet - `group`, then samples
+    * groups2records.parquet - `record`, then one 0/1 column per group
+    * sub_tables.parquet - the sub tables, one per group, in long format:
+      `group`, `record`, then samples, one row per (group, member record)
+
+    Return filepaths written
+    '''
+    col_ids = result.collapsed_df.columns.tolist()
+    data = np.asarray(data, dtype=float).reshape(result.num_records, len(col_ids))
+    records = pd.Series(result.records, dtype=object)
+    flpths = []
+
+    def write(df, flnm):
+        flpth = os.path.join(out_dir, flnm)
+        df.to_parquet(flpth, index=False, compression=compression)
+        flpths.append(flpth)
+
+    if row_ids is not None:
+        otu_df = pd.DataFrame(data, columns=col_ids)
+        otu_df.insert(0, 'OTU_Id', row_ids)
+        otu_df.insert(0, 'taxonomy', records)
+        write(otu_df, 'otu_table.parquet')
+
+    write(result.collapsed_df.reset_index(), 'collapsed_func_table.parquet')
+
+    g2r_df = pd.DataFrame(result.membership.T.toarray(), columns=result.group_names)
+    g2r_df.insert(0, 'record', records)
+    write(g2r_df, 'groups2records.parquet')
+
+    # group-major coordinates of the membership, records ascending within group
+    coo = result.membership.tocoo()
+    order = np.lexsort((coo.col, coo.row))
+    group_inds, record_inds = coo.row[order], coo.col[order]
+
+    sub_df = pd.DataFrame(data[record_inds], columns=col_ids)
+    sub_df.insert(0, 'record', records.values[record_inds])
+    sub_df.insert(0, 'group', pd.Categorical.from_codes(group_inds, categories=result.group_names))
+    write(sub_df, 'sub_tables.parquet')
+
+    return flpths
+
+
+####################################################################################################
+####################################################################################################
+def write_sparse_membership(out_dir, result: FaprotaxResult, fmt='npz', name='groups2records') -> list:
+    '''
+    Write records x groups 0/1 membership, i.e. groups2records.tsv, in sparse form to `out_dir`
+    * `<name>.npz` - CSR, for `scipy.sparse.load_npz`, if `fmt` is `npz`
+    * `<name>.mtx` - Matrix Market coordinate format, if `fmt` is `mtx`
+    * `<name>.rows.txt.gz` - row labels, one record per line, gzipped since taxonomies repeat and are long
+    * `<name>.cols.txt` - column labels, one group per line
+
+    Return filepaths written
+    '''
+    by_record = result.membership.T.tocsr()
+    flpths = []
+
+    if fmt == 'npz':
+        flpth = os.path.join(out_dir, name + '.npz')
+        sparse.save_npz(flpth, by_record, compressed=True)
+    elif fmt == 'mtx':
+        flpth = os.path.join(out_dir, name + '.mtx')
+        scipy.io.mmwrite(flpth, by_record, field='integer')
+    else:
+        raise Exception('Unknown sparse format `%s`' % fmt)
+    flpths.append(flpth)
+
+    for labels, flnm, open_ in [
+            (result.records, name + '.rows.txt.gz', gzip.open), (result.group_names, name + '.cols.txt', open)]:
+        flpth = os.path.join(out_dir, flnm)
+        with open_(flpth, 'wt') as fh:
+            for label in labels:
+                fh.write(('' if label is None else label) + '\n')
+        flpths.append(flpth)
+
+    return flpths
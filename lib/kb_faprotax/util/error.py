@@ -6,5 +6,7 @@ class NonZeroReturnException(Exception): pass
 
 class ValidationException(Exception): pass
 
+class DatabaseParseException(Exception): pass
+
 msg_dupGenomes = (
 'Duplicate referenced Genomes in GenomeSet')
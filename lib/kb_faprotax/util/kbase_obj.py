@@ -1,5 +1,6 @@
 import re
 import os
+import io
 import logging
 import pandas as pd
 import numpy as np
@@ -30,8 +31,10 @@ class AmpliconMatrix:
         * upa
         * name
         * obj
+        * row_id2ind - row id -> row index
         '''
         self.upa = upa
+        self._values = None # (`values` list, its float array), see `get_values`
 
         self._get_obj()
 
@@ -45,6 +48,7 @@ class AmpliconMatrix:
 
         self.name = obj['data'][0]['info'][1]
         self.obj = obj['data'][0]['data']
+        self.row_id2ind = {id: i for i, id in enumerate(self.obj['data']['row_ids'])}
 
         # comment run_dir with AmpliconMatrix name
         if Var.debug and 'run_dir' in Var and os.path.exists(Var.run_dir):
@@ -52,6 +56,26 @@ class AmpliconMatrix:
         
 
 
+    def get_values(self) -> np.ndarray:
+        '''
+        `values` as a C-contiguous float array, missing values as NaN
+        Converted once and cached for every later consumer,
+        until `obj['data']['values']` is reassigned
+        '''
+        values = self.obj['data']['values']
+
+        if self._values is None or self._values[0] is not values:
+            try:
+                a = np.array(values, dtype=float) # `None` -> NaN
+            except (ValueError, TypeError):
+                a = vd.as_numeric(np.array(values, dtype=object))
+                if a is None:
+                    raise ValidationException('Input AmpliconMatrix has non-numeric values')
+            self._values = (values, np.ascontiguousarray(a))
+
+        return self._values[1]
+
+
     def to_OTU_table(self, tax_l, flpth=None):
         '''
         `taxonomy` is index
@@ -59,11 +83,12 @@ class AmpliconMatrix:
 
         This interface is used for testing
         Return df for testing
+        Elsewhere, use `write_OTU_table`, which does not hold copies of the matrix
         '''
 
         logging.info(f"Parsing AmpliconMatrix data from object")
 
-        data = np.array(self.obj['data']['values'], dtype=float)
+        data = self.get_values()
         row_ids = self.obj['data']['row_ids']
         col_ids = self.obj['data']['col_ids']
 
@@ -82,6 +107,58 @@ class AmpliconMatrix:
         return df
 
 
+    def iter_OTU_table(self, tax_l, chunk_size=1000, max_block_cells=1000000):
+        '''
+        Yield the same TSV as `to_OTU_table`, in text blocks of `chunk_size` rows,
+        without building a DataFrame
+        Only one block of text exists at a time, and blocks shrink to at most `max_block_cells` values
+        for very wide matrices. The float matrix itself is the whole `get_values` array,
+        converted once and shared with validation and the engine
+
+        Values are formatted vectorized with numpy's shortest round-trip float repr,
+        which is what `to_csv` writes, and missing values are left empty
+        '''
+        row_ids = self.obj['data']['row_ids']
+        col_ids = self.obj['data']['col_ids']
+        values = self.get_values().reshape(-1, len(col_ids))
+
+        chunk_size = max(1, min(chunk_size, max_block_cells // max(1, len(col_ids))))
+
+        buf = io.StringIO() # reused across blocks
+
+        yield '\t'.join(['taxonomy', 'OTU_Id'] + col_ids) + '\n'
+
+        for start in range(0, len(row_ids), chunk_size):
+            stop = start + chunk_size
+
+            block = values[start:stop]
+            block_strs = block.astype(str)
+            block_strs[np.isnan(block)] = ''
+
+            buf.seek(0)
+            buf.truncate()
+            for tax, row_id, row_strs in zip(tax_l[start:stop], row_ids[start:stop], block_strs.tolist()):
+                buf.write('' if tax is None else tax)
+                buf.write('\t')
+                buf.write(row_id)
+                buf.write('\t')
+                buf.write('\t'.join(row_strs))
+                buf.write('\n')
+
+            yield buf.getvalue()
+
+
+    def write_OTU_table(self, tax_l, flpth, chunk_size=1000):
+        '''
+        Write the `to_OTU_table` TSV by streaming `iter_OTU_table` blocks
+        '''
+        logging.info(f"Writing AmpliconMatrix data to OTU table `{flpth}`")
+
+        with open(flpth, 'w') as fh:
+            for block in self.iter_OTU_table(tax_l, chunk_size=chunk_size):
+                fh.write(block)
+
+
     def validate_amplicon_abundance_data(self):
         '''
         Can't be all missing
@@ -91,51 +168,53 @@ class AmpliconMatrix:
         Because of KBase float types, which this is composed of,
         don't have to worry about complex, inf, etc.
         '''
-        a = np.array(self.obj['data']['values'])
+        a = self.get_values()
+        missing = np.isnan(a)
 
         # Can't be all missing
-        if vd.get_num_missing(a) == a.size:
+        if missing.all():
             raise ValidationException(
                 'Input AmpliconMatrix cannot be all missing values'
             )
 
-        a = vd.as_numeric(a, dtype=float) # casting as int will truncate floats into ints
-
         base_msg = (
             'Input AmpliconMatrix must have count data (missing values allowed). '
         )
 
-        # Integer
-        if not vd.is_int_like(a):
+        # Integer and gte 0, off one rounding
+        # Same tolerances as `vd.is_int_like`, allowing for small deltas
+        a_round = np.round(a)
+        with np.errstate(invalid='ignore'):
+            int_like = np.abs(a - a_round) <= 1e-8 + 1e-8 * np.minimum(np.abs(a), np.abs(a_round))
+
+        if not (int_like | missing).all():
             raise ValidationException(
                 base_msg + 'Non-integer detected'
             )
 
-        # Gte 0
-        if np.any(np.round(a) < 0): # allow for small negative deltas
+        if np.any(a_round[~missing] < 0):
             raise ValidationException(
                 base_msg + 'Negative value detected'
             )
 
-    def _map_id2attr_ids(self, id2attr, axis='row'):
+    def _map_attr_rows(self, id2row: dict, axis='row') -> np.ndarray:
         '''
         Parameters
         ----------
-        id2attr - AmpliconMatrix row_ids to attribute you want to give AttributeMapping
+        id2row - AttributeMapping ids to their row index
 
         Behavior
         --------
-        Swap out ids in id2attr so they end up mapping AttributeMapping ids to attributes
+        Return array mapping each AmpliconMatrix row (or col) index to its AttributeMapping row index,
+        so attributes in AmpliconMatrix order can be scattered into AttributeMapping columns
         '''
-        if f'{axis}_mapping' not in self.obj:
-            pass
+        ids = self.obj['data'][f'{axis}_ids']
+        mapping = self.obj.get(f'{axis}_mapping')
 
-        id2attr = {
-            self.obj[f'{axis}_mapping'][id]: attr
-            for id, attr in id2attr.items()
-        }
-
-        return id2attr
+        return np.array(
+            [id2row[mapping[id] if mapping is not None else id] for id in ids],
+            dtype=np.intp
+        )
 
     def save(self):
         
@@ -164,7 +243,11 @@ class AttributeMapping:
         * upa
         * amp_mat
         * name
-        * obj
+        * obj - without `instances`, which are held column-wise until `save`
+        * ids - instance ids, in workspace order
+        * id2row - instance id -> row index into columns
+        * columns - one object array per attribute, indexed by row
+        * amp_rows - AmpliconMatrix row index -> row index
         '''
         self.upa = upa
         self.amp_mat = amp_mat
@@ -179,7 +262,32 @@ class AttributeMapping:
         })
 
         self.name = obj['data'][0]['info'][1]
-        self.obj = obj['data'][0]['data']
+        obj = obj['data'][0]['data']
+
+        self.obj = {key: value for key, value in obj.items() if key != 'instances'}
+        self._from_instances(obj['instances'])
+
+        self.amp_rows = self.amp_mat._map_attr_rows(self.id2row, axis='row')
+
+    def _from_instances(self, instances: dict):
+        '''
+        Workspace dict of id -> list of attribute values to columns
+        '''
+        self.ids = list(instances.keys())
+        self.id2row = {id: i for i, id in enumerate(self.ids)}
+        self.columns = []
+
+        for values in zip(*instances.values()) if instances else [()] * self.attributes_length:
+            column = np.empty(len(self.ids), dtype=object)
+            column[:] = values
+            self.columns.append(column)
+
+    def _to_instances(self) -> dict:
+        '''
+        Columns back to the workspace dict of id -> list of attribute values
+        '''
+        columns = [column.tolist() for column in self.columns]
+        return {id: list(values) for id, values in zip(self.ids, zip(*columns))} if columns else {id: [] for id in self.ids}
 
     @property
     def attributes_length(self):
@@ -187,10 +295,10 @@ class AttributeMapping:
 
     @property
     def instances_length(self):
-        return len(next(iter(self.obj['instances'].values()))[0])
+        return len(self.ids)
 
     def get_attributes_at(self, ind):
-        return [instance[ind] for instance in self.obj['instances'].values()]
+        return self.columns[ind].tolist()
 
     def get_attr_ind(self, tax_field):
         '''
@@ -207,25 +315,35 @@ class AttributeMapping:
 
 
     def get_ordered_tax_l(self, tax_ind, id_l):
-        tax_l = []
+        rows = [self.id2row[id] for id in id_l]
 
-        for id in id_l:
-            tax_l.append(
-                self.obj['instances'][id][tax_ind]
-            )
+        return self.columns[tax_ind][rows].tolist()
 
-        return tax_l
+
+    def update_attribute(self, ind: int, attrs: list):
+        '''
+        Update attribute at index `ind` with `attrs`, which are in AmpliconMatrix row order,
+        as one scatter through `amp_rows`
+        '''
+        column = np.empty(len(attrs), dtype=object)
+        column[:] = attrs
+
+        self.columns[ind][self.amp_rows] = column
 
 
     def map_update_attribute(self, ind: int, id2attr: dict):
         '''
-        First map ids of `id2attr` to AttributeMapping ids using amp_mat's row_mapping
-        Update attribute at index `ind` using mapping `id2attr`
+        Update attribute at index `ind` using mapping `id2attr` of AmpliconMatrix row ids,
+        which are mapped to rows through `amp_rows`
         '''
-        id2attr = self.amp_mat._map_id2attr_ids(id2attr, axis='row')
+        if not id2attr:
+            return
+
+        rows = self.amp_rows[[self.amp_mat.row_id2ind[id] for id in id2attr]]
+        attrs = np.empty(len(rows), dtype=object)
+        attrs[:] = list(id2attr.values())
 
-        for id, attr in id2attr.items():
-            self.obj['instances'][id][ind] = attr
+        self.columns[ind][rows] = attrs
 
 
     def add_attribute_slot(self, attribute, source) -> tuple:
@@ -243,8 +361,7 @@ class AttributeMapping:
             'attribute': attribute,
             'source': source,
         })
-        for instance in self.obj['instances'].values():
-            instance.append(None)
+        self.columns.append(np.full(len(self.ids), None, dtype=object))
         #
         return len(self.obj['attributes']) - 1, attribute
 
@@ -253,7 +370,7 @@ class AttributeMapping:
             'id': Var.params['workspace_id'],
             "objects": [{
                 "type": "KBaseExperiments.AttributeMapping",
-                "data": self.obj,
+                "data": {**self.obj, 'instances': self._to_instances()},
                 "name": self.name,
                 "extra_provenance_input_refs": [self.upa]
              }]})[0]
@@ -274,9 +391,8 @@ class AttributeMapping:
         assert self.obj['attributes'][ind]['source'] == source
         
     
-        instances = self.obj['instances']
-        for id, instance in instances.items():
-            assert instance[ind] == id2attr.get(id)
+        for id, attr in zip(self.ids, self.get_attributes_at(ind)):
+            assert attr == id2attr.get(id)
 
         return True
 
@@ -0,0 +1,176 @@
+import re
+import logging
+from collections import deque
+import numpy as np
+
+from .dprint import dprint
+from .database import FaprotaxDB
+
+'''
+Match taxonomy paths ('records') against FAPROTAX member patterns
+
+Each member pattern, e.g. `*Proteobacteria*Nitrosomonas*`, is indexed under one key token,
+its rarest (ties go to the longest). An Aho-Corasick automaton over the key tokens
+finds every key token in a record in one pass, which yields a small candidate set of patterns,
+and only those are verified
+'''
+
+
+
+####################################################################################################
+####################################################################################################
+def compile_member(member):
+    '''
+    Members are `*`-wildcarded, case-insensitive taxon patterns,
+    e.g., `*Proteobacteria*Nitrosomonas*`
+    '''
+    regex = '^' + '.*'.join(re.escape(token) for token in member.split('*')) + '$'
+    return re.compile(regex, re.IGNORECASE | re.DOTALL)
+
+
+####################################################################################################
+####################################################################################################
+class TaxonMatcher:
+    '''
+    Instance variables created during init:
+    * db
+    * patterns - indices of the member patterns matched, default all
+    * key2patterns - key token index -> pattern indices
+    * always - indices of patterns without any literal token, e.g. `*`
+    * goto, fail, out - Aho-Corasick automaton over key tokens
+    '''
+
+    def __init__(self, db: FaprotaxDB, patterns=None):
+        self.db = db
+        self.patterns = list(range(len(db.patterns))) if patterns is None else list(patterns)
+        self._regexes = {}
+
+        self._index_patterns()
+        self._build_automaton()
+
+    def _index_patterns(self):
+        token_counts = {}
+        for p in self.patterns:
+            for t in set(self.db.pattern_tokens[p]):
+                token_counts[t] = token_counts.get(t, 0) + 1
+
+        self.key2patterns = {}
+        self.always = []
+
+        for p in self.patterns:
+            token_inds = self.db.pattern_tokens[p]
+            literal = [t for t in token_inds if self.db.tokens[t] != '']
+            if not literal:
+                self.always.append(p)
+                continue
+            key = min(literal, key=lambda t: (token_counts[t], -len(self.db.tokens[t])))
+            self.key2patterns.setdefault(key, []).append(p)
+
+    def _build_automaton(self):
+        goto = [{}]
+        out = [[]]
+
+        for t in self.key2patterns:
+            state = 0
+            for ch in self.db.tokens[t]:
+                if ch not in goto[state]:
+                    goto[state][ch] = len(goto)
+                    goto.append({})
+                    out.append([])
+                state = goto[state][ch]
+            out[state].append(t)
+
+        # breadth-first fail links, inheriting outputs of suffix states
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0) if goto[f].get(ch, 0) != nxt else 0
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+
+    def _find_key_tokens(self, record) -> set:
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        state = 0
+        for ch in record.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def _verify(self, p, record) -> bool:
+        if p not in self._regexes:
+            self._regexes[p] = compile_member(self.db.patterns[p])
+        return self._regexes[p].match(record) is not None
+
+    def match_patterns(self, record) -> list:
+        '''
+        Indices of member patterns matching `record`, ascending
+        '''
+        if not isinstance(record, str): # missing taxonomy
+            return []
+
+        candidates = [p for t in self._find_key_tokens(record) for p in self.key2patterns[t]] + self.always
+
+        return sorted(p for p in set(candidates) if self._verify(p, record))
+
+    def match_groups(self, record) -> list:
+        '''
+        Indices of groups `record` belongs to, ascending,
+        applying each group's operations in order.
+        Only exact for groups whose patterns are all in `self.patterns`
+        '''
+        hits = set(self.match_patterns(record))
+        member = []
+
+        for group_ops in self.db.ops:
+            b = False
+            for op, ind in group_ops:
+                if op == 'member':
+                    b = b or ind in hits
+                elif op == 'add_group':
+                    b = b or member[ind]
+                elif op == 'subtract_group':
+                    b = b and not member[ind]
+                elif op == 'intersect_group':
+                    b = b and member[ind]
+            member.append(b)
+
+        return [i for i, b in enumerate(member) if b]
+
+    def match_patterns_many(self, records) -> tuple:
+        '''
+        Coordinates `(pattern_inds, record_inds)` of all hits,
+        since patterns x records is almost entirely misses
+        '''
+        pattern_inds = []
+        record_inds = []
+        for j, record in enumerate(records):
+            hits = self.match_patterns(record)
+            pattern_inds.extend(hits)
+            record_inds.extend([j] * len(hits))
+        return np.array(pattern_inds, dtype=np.intp), np.array(record_inds, dtype=np.intp)
+
+
+####################################################################################################
+####################################################################################################
+_matchers = {} # (database hash, patterns) -> TaxonMatcher, for this process
+
+
+def get_matcher(db: FaprotaxDB, patterns=None) -> TaxonMatcher:
+    key = (db.hash, None if patterns is None else tuple(patterns))
+    if key not in _matchers:
+        logging.info('Building taxon matcher for FAPROTAX database')
+        _matchers[key] = TaxonMatcher(db, patterns)
+    return _matchers[key]
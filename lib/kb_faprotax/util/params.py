@@ -2,6 +2,7 @@ import json
 
 from .dprint import dprint
 from .varstash import Var
+from .engine import OutputWriter
 
 
 
@@ -13,6 +14,16 @@ class Params:
 
 
     DEFAULTS = {
+        'faprotax_engine': 'native', # or `subprocess` to shell out to `collapse_table.py`
+        'stream_otu_table': True, # with `subprocess`, pipe OTU table to stdin instead of writing it
+        'collapse_dtype': 'float64', # or `float32` to halve collapse memory
+        'sample_block_size': 1000, # collapse this many samples at a time, bounding collapse temporaries
+        'memo_cache': True, # look up/store taxonomy -> groups in on-disk memo
+        'num_workers': None, # processes to shard the native engine's matching across. Default the job's CPUs
+        'group_metadata_filter': None, # e.g. `{'elements': 'N'}` to only run nitrogen-cycle groups
+        'faprotax_outputs': None, # optional artifacts to write, e.g. `['report']`. Default all
+        'export_format': 'tsv', # or `parquet` to swap the big output TSVs for compressed columnar files. AmpliconMatrix only
+        'sparse_groups2records': 'npz', # or `mtx`, or None to not write sparse groups2records. AmpliconMatrix only
     }
 
     def __init__(self, params):
@@ -41,6 +52,17 @@ class Params:
             'tax_field',
             'output_amplicon_matrix_name',
             #---
+            'faprotax_engine',
+            'stream_otu_table',
+            'collapse_dtype',
+            'sample_block_size',
+            'memo_cache',
+            'num_workers',
+            'group_metadata_filter',
+            'faprotax_outputs',
+            'export_format',
+            'sparse_groups2records',
+            #---
             'workspace_id',
             'workspace_name',
         ]
@@ -49,6 +71,43 @@ class Params:
             if p not in VALID:
                 raise Exception(p)
 
+        if params.get('faprotax_engine', 'native') not in ['native', 'subprocess']:
+            raise Exception('`faprotax_engine` must be `native` or `subprocess`')
+
+        if params.get('export_format', 'tsv') not in ['tsv', 'parquet']:
+            raise Exception('`export_format` must be `tsv` or `parquet`')
+
+        if params.get('sparse_groups2records', 'npz') not in ['npz', 'mtx', None]:
+            raise Exception('`sparse_groups2records` must be `npz`, `mtx` or None')
+
+        num_workers = params.get('num_workers')
+        if num_workers is not None and not (isinstance(num_workers, int) and num_workers >= 1):
+            raise Exception('`num_workers` must be a positive integer')
+
+        sample_block_size = params.get('sample_block_size')
+        if sample_block_size is not None and not (isinstance(sample_block_size, int) and sample_block_size >= 1):
+            raise Exception('`sample_block_size` must be a positive integer')
+
+        if params.get('collapse_dtype', 'float64') not in ['float64', 'float32']:
+            raise Exception('`collapse_dtype` must be `float64` or `float32`')
+
+        group_metadata_filter = params.get('group_metadata_filter')
+        if group_metadata_filter is not None and not (
+                isinstance(group_metadata_filter, dict) and all(
+                    isinstance(v, str) or (isinstance(v, list) and all(isinstance(e, str) for e in v))
+                    for v in group_metadata_filter.values())):
+            raise Exception('`group_metadata_filter` must map metadata keys to a value or list of values')
+
+        if group_metadata_filter is not None and params.get('faprotax_engine') == 'subprocess':
+            raise Exception('`group_metadata_filter` requires the `native` FAPROTAX engine')
+
+        faprotax_outputs = params.get('faprotax_outputs')
+        if faprotax_outputs is not None:
+            if not isinstance(faprotax_outputs, list) or not set(faprotax_outputs) <= set(OutputWriter.ARTIFACTS):
+                raise Exception('`faprotax_outputs` must be a list of any of %s' % list(OutputWriter.ARTIFACTS))
+            if params.get('faprotax_engine') == 'subprocess':
+                raise Exception('`faprotax_outputs` requires the `native` FAPROTAX engine')
+
 
 
     def __getitem__(self, key):
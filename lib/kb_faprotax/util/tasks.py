@@ -0,0 +1,57 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .dprint import dprint
+
+'''
+Run interdependent remote calls (object saves, FunctionalProfile imports, report)
+concurrently where their dependencies allow
+'''
+
+
+
+####################################################################################################
+####################################################################################################
+def run_tasks(tasks: dict, max_workers=4) -> dict:
+    '''
+    Input:
+    * tasks - name -> `(func, deps)`, where `deps` are names of tasks that must finish first.
+      `func` is called with the results of `deps`, in order
+    * max_workers
+
+    Output:
+    * name -> result
+
+    Each task starts as soon as its dependencies finish
+    The first exception raised by a task is re-raised, after running tasks finish,
+    and tasks not yet started are dropped
+    '''
+    for name, (func, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise Exception('Task `%s` depends on unknown task `%s`' % (name, dep))
+
+    results = {}
+    pending = dict(tasks)
+    running = {} # future -> name
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    logging.info('Starting task `%s`' % name)
+                    running[executor.submit(func, *[results[dep] for dep in deps])] = name
+                    del pending[name]
+
+            if not running:
+                raise Exception('Tasks %s have circular dependencies' % list(pending))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                logging.info('Finished task `%s`' % name)
+
+    return results
@@ -9,8 +9,40 @@ from .dprint import dprint
 ####################################################################################################
 MISSING_VALS = [None, '', 'None', np.nan] # Below functions should implicitly handle these missing values
 
+
+def _is_missing(x) -> bool:
+    return x is None or (isinstance(x, str) and x in ('', 'None')) or (isinstance(x, float) and x != x)
+
+_is_missing_ufunc = np.frompyfunc(_is_missing, 1, 1)
+
+
 class Validate:
     
+####################################################################################################
+####################################################################################################
+    @classmethod
+    def get_missing_mask(cls, a: np.ndarray) -> np.ndarray:
+        '''
+        Boolean mask of `MISSING_VALS` entries, in one pass over `a`
+        * Numeric arrays can only hold missing values as NaN, so never touch Python objects
+        * String arrays can only hold `''` and `'None'`
+        * Object arrays are first tried as numbers with `None` -> NaN,
+          which is C-speed for the usual KBase `values` of int/float/None,
+          and otherwise checked element by element, once
+        '''
+        if a.dtype.kind in 'fc':
+            return np.isnan(a)
+        if a.dtype.kind in 'iub':
+            return np.zeros(a.shape, dtype=bool)
+        if a.dtype.kind in 'US':
+            empty, none = ('', 'None') if a.dtype.kind == 'U' else (b'', b'None')
+            return (a == empty) | (a == none)
+
+        try:
+            return np.isnan(np.where(np.equal(a, None), np.nan, a).astype(float))
+        except (ValueError, TypeError): # strings
+            return _is_missing_ufunc(a).astype(bool)
+
 ####################################################################################################
 ####################################################################################################
     @classmethod
@@ -23,21 +55,7 @@ class Validate:
         if np.issubdtype(a.dtype, int) and rep in [np.nan, None]:
             raise Exception('Cannot assign special missing values to numpy integer array')
 
-        for missing in MISSING_VALS:
-            """
-            dprint( 
-                    'missing',
-                    'type(missing)',
-                    'a', 
-                    'a.dtype', 
-                    'a == np.array(missing, dtype=object)', 
-                    run={**globals(),**locals()}
-                    )
-            """
-            try:
-                a[a == np.array(missing, dtype=object)] = rep
-            except:
-                raise Exception(missing)
+        a[cls.get_missing_mask(a)] = rep
 
         return a
 
@@ -45,23 +63,7 @@ class Validate:
 ####################################################################################################
     @classmethod
     def get_num_missing(cls, a: np.ndarray):
-        num = 0
-        for missing in MISSING_VALS:
-            
-            """
-            dprint( 
-                    'missing',
-                    'type(missing)',
-                    'a', 
-                    'a.dtype', 
-                    'a == np.array(missing, dtype=object)', 
-                    run={**globals(),**locals()}
-                    )
-            """
-            
-            num = num + (a == np.array(missing, dtype=object)).sum() # cast missing as obj np.array to get element-wise comparison
-        
-        return num
+        return int(cls.get_missing_mask(a).sum())
 
 
 ####################################################################################################
@@ -12,6 +12,8 @@ _config = DotMap({
 #----- run cmd
     'db_flpth': '/kb/module/data/FAPROTAX.txt', # curated database file for FAPROTAX
     'cmd_flpth': '/opt/FAPROTAX_1.2.1/collapse_table.py', # FAPROTAX executable
+    'memo_cache_flnm': 'faprotax_memo.sqlite', # taxonomy -> groups memo, under `shared_folder`
+    'memo_cache_max_entries': 1000000,
 
 
 
@@ -4,7 +4,6 @@ import sys
 import uuid
 import subprocess
 import functools
-import pandas as pd
 import numpy as np
 import json
 import shutil
@@ -14,61 +13,214 @@ from .dprint import dprint
 from .varstash import Var
 from .error import *
 from .kbase_obj import AmpliconMatrix, AttributeMapping, GenomeSet, Genome
+from .engine import collapse_table, get_num_workers, FaprotaxResult
+from .engine import OutputWriter, write_outputs, write_parquet_outputs, write_sparse_membership
+from .cache import TaxonomyCache
+from .tasks import run_tasks
 
 
 
 ####################################################################################################
-def run_check(cmd):
+def run_check(cmd, stdin_chunks=None):
     '''
     Wrap tool-running method for patching
+    `stdin_chunks` - optional iterable of text chunks streamed to the command's stdin
     '''
     logging.info(f'Running FAPROTAX via command `{cmd}`')
-    completed_proc = subprocess.run(cmd, shell=True, executable='/bin/bash', stdout=sys.stdout, stderr=sys.stdout)
 
-    if completed_proc.returncode != 0:
+    if stdin_chunks is None:
+        returncode = subprocess.run(
+            cmd, shell=True, executable='/bin/bash', stdout=sys.stdout, stderr=sys.stdout).returncode
+
+    else:
+        proc = subprocess.Popen(
+            cmd, shell=True, executable='/bin/bash', stdin=subprocess.PIPE, stdout=sys.stdout, stderr=sys.stdout)
+        try:
+            for chunk in stdin_chunks:
+                proc.stdin.write(chunk.encode())
+        except BrokenPipeError: # command exited early, return code will tell
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = proc.wait()
+
+    if returncode != 0:
         msg = (
-"FAPROTAX command `%s` returned with non-zero return code `%d`. Please check logs for more details" % (cmd, completed_proc.returncode))
+"FAPROTAX command `%s` returned with non-zero return code `%d`. Please check logs for more details" % (cmd, returncode))
         raise NonZeroReturnException(msg)
 
 
+####################################################################################################
+def fetch_AmpliconMatrix(upa) -> tuple:
+    '''
+    Fetch AmpliconMatrix `upa` and its row AttributeMapping, which is None if it has none
+    '''
+    amp_mat = AmpliconMatrix(upa)
+
+    row_attr_map_upa = amp_mat.obj.get('row_attributemapping_ref')
+    if row_attr_map_upa is None:
+        return amp_mat, None
+
+    row_attr_map = AttributeMapping(row_attr_map_upa, amp_mat)
+
+    return amp_mat, row_attr_map
+
 
 ####################################################################################################
-def parse_tax2groups(groups2records_table_dense_flpth, dlm=',') -> dict:
-    tax2groups_df = pd.read_csv(groups2records_table_dense_flpth, sep='\t', comment='#').fillna('')
-    return tax2groups_df['record'].tolist(), tax2groups_df['group'].tolist()
+def get_prefetched(name, *args):
+    '''
+    Join work `name` that `run_FAPROTAX` started early in `Var.prefetch`,
+    which maps name -> (future, args it was started with)
+    Return None if it wasn't started with the same `args`, or failed, for the caller to redo it
+    '''
+    if 'prefetch' not in Var or name not in Var.prefetch:
+        return None
+
+    future, prefetch_args = Var.prefetch.pop(name)
+    if prefetch_args != args:
+        return None
+
+    try:
+        return future.result()
+    except Exception as e:
+        logging.warning('Prefetched `%s` failed, redoing: %s' % (name, e))
+        return None
 
 
 ####################################################################################################
-def parse_faprotax_functions(groups2records_table_dense_flpth, dlm=',') -> dict: # TODO does same thing as parse_tax2groups
+def drop_prefetched(name):
     '''
-    In FAPROTAX, a taxonomic path is also known as a 'record', and a
-    function is also known as a 'group'.
-    The input is a filepath for grouops2records_dense.tsv, which is one of
-    the outputs from FAPROTAX. Basically, its index is the records, its columns
-    are the groups, and its values are nonnegative floats
-    Input: filepath for groups2records_dense.tsv
-    Output: dict map from taxonomy to predicted functions
+    Discard work `name` in `Var.prefetch` that turned out not to be needed,
+    cancelling it if it hasn't started, else waiting for it so it doesn't outlive the run
     '''
-    g2r_df = pd.read_csv(groups2records_table_dense_flpth, sep='\t', comment='#')
-    g2r_df = g2r_df.fillna('').drop_duplicates().set_index('record')
+    if 'prefetch' not in Var or name not in Var.prefetch:
+        return
+
+    future, _ = Var.prefetch.pop(name)
+    if future.cancel():
+        return
+
+    try:
+        future.result()
+    except Exception as e:
+        logging.info('Discarded prefetched `%s` failed: %s' % (name, e))
+
+
+def shutdown_prefetch():
+    '''
+    Drop prefetched work nobody joined and stop the prefetch threads
+    '''
+    for name in list(Var.prefetch) if 'prefetch' in Var else []:
+        drop_prefetched(name)
+
+    if 'prefetch_executor' in Var:
+        Var.prefetch_executor.shutdown(wait=True)
+
+
+####################################################################################################
+def run_native(tax_l, data, col_ids) -> FaprotaxResult:
+    '''
+    Run FAPROTAX in-process
+    Write its outputs with `write_native_outputs`
+    '''
+    get_prefetched('db', Var.db_flpth) # join database load/compile
+    shutdown_prefetch() # no other threads may be alive when sharding forks workers
+
+    cache = None
+    if Var.params.getd('memo_cache'):
+        cache = TaxonomyCache(
+            os.path.join(Var.shared_folder, Var.memo_cache_flnm), max_entries=Var.memo_cache_max_entries)
+
+    try:
+        result = collapse_table(
+            tax_l, data, col_ids,
+            dtype=np.dtype(Var.params.getd('collapse_dtype')),
+            cache=cache,
+            group_filter=Var.params.getd('group_metadata_filter'),
+            num_workers=Var.params.getd('num_workers') or get_num_workers(),
+            sample_block_size=Var.params.getd('sample_block_size'),
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return result
+
+
+####################################################################################################
+def write_native_outputs(result: FaprotaxResult, data, skip=()):
+    '''
+    Write the outputs `collapse_table.py` would to `Var.out_dir`,
+    those in `faprotax_outputs` (default all) but not in `skip`
+    Skipped artifacts can be written later through `Var.output_writer`
+    '''
+    artifacts = Var.params.getd('faprotax_outputs')
+    artifacts = [
+        artifact for artifact in (OutputWriter.ARTIFACTS if artifacts is None else artifacts)
+        if artifact not in skip
+    ]
+
+    Var.output_writer = write_outputs(Var.out_dir, result, data, artifacts=artifacts)
+
+
+
+####################################################################################################
+def export_sparse_groups2records(result: FaprotaxResult, fmt, min_ratio=4) -> bool:
+    '''
+    Write sparse groups2records with label files to `Var.out_dir`
+    Return whether the dense groups2records.tsv is still worth having,
+    i.e. would be less than `min_ratio` times bigger. Its size is computed, not written,
+    so the native engine can skip it. If `collapse_table.py` already wrote it, it is dropped
+    '''
+    flpths = write_sparse_membership(Var.out_dir, result, fmt=fmt)
+
+    sparse_size = sum(os.path.getsize(flpth) for flpth in flpths)
+    dense_size = result.get_membership_tsv_size()
+
+    if dense_size < min_ratio * sparse_size:
+        return True
 
-    r2g_d = g2r_df.to_dict(orient='index')
-    r2g_d = {record: r2g_d[record]['group'] for record in r2g_d}
-    if dlm != ',': 
-        r2g_d = {record: group.replace(',', dlm) for record, group in r2g_d.items()}
+    logging.info(
+        'Dropping dense groups2records (%d bytes) for sparse groups2records (%d bytes)' % (dense_size, sparse_size))
+
+    dense_flpth = os.path.join(Var.out_dir, 'groups2records.tsv')
+    if os.path.exists(dense_flpth):
+        os.remove(dense_flpth)
+
+    return False
 
-    return r2g_d
 
 ####################################################################################################
-def map_groups2records_to_groups2ids(groups2records_table_flpth, groups2ids_table_flpth, id_l):
+def export_parquet(result: FaprotaxResult, data, row_ids=None):
+    '''
+    Swap the big TSVs in `Var.return_dir` for Parquet files in `Var.out_dir`
+    `collapsed_func_table.tsv` stays, since the sample FunctionalProfile is imported from it
+    '''
+    write_parquet_outputs(Var.out_dir, result, data, row_ids=row_ids)
 
-    tax2groups_df = pd.read_csv(groups2records_table_flpth, sep='\t', comment='#').fillna('')
+    for flpth in [
+            os.path.join(Var.return_dir, 'otu_table.tsv'), 
+            os.path.join(Var.out_dir, 'groups2records.tsv')]:
+        if os.path.exists(flpth):
+            os.remove(flpth)
+    for sub_tables_dir in ['sub_tables', OutputWriter.ARTIFACTS['sub_tables']]: # `collapse_table.py`'s, native
+        shutil.rmtree(os.path.join(Var.out_dir, sub_tables_dir), ignore_errors=True)
 
-    df = tax2groups_df.drop('record', axis=1)
-    df.index = id_l
-    df.index.name = 'id'
+    if 'output_writer' in Var:
+        for artifact in ['groups2records', 'sub_tables']:
+            Var.output_writer.written.pop(artifact, None)
 
-    df.to_csv(groups2ids_table_flpth, sep='\t', header=True, index=True)
+
+####################################################################################################
+def map_groups2records_to_groups2ids(result: FaprotaxResult, groups2ids_table_flpth, id_l):
+    '''
+    Write the groups x records membership relabeled by `id_l`, for the amplicon FunctionalProfile,
+    streamed straight from the sparse membership
+    '''
+    result.write_membership_tsv(groups2ids_table_flpth, row_ids=id_l, index_name='id')
 
 
     
@@ -89,10 +241,10 @@ def do_AmpliconMatrix_workflow():
     ####
     #####
 
-    amp_mat = AmpliconMatrix(Var.params['input_upa'])
+    fetched = get_prefetched('AmpliconMatrix', Var.params['input_upa'])
+    amp_mat, row_attr_map = fetched if fetched is not None else fetch_AmpliconMatrix(Var.params['input_upa'])
 
-    row_attr_map_upa = amp_mat.obj.get('row_attributemapping_ref')
-    if row_attr_map_upa is None:
+    if row_attr_map is None:
         msg = (
 "Input AmpliconMatrix %s does not have a row AttributeMapping object to grab taxonomy from and assign traits to. "
 "To upload a row AttributeMapping with taxonomy, try running attribute mapping import app. "
@@ -101,7 +253,6 @@ def do_AmpliconMatrix_workflow():
         )
         raise NoWsReferenceException(msg)
 
-    row_attr_map = AttributeMapping(row_attr_map_upa, amp_mat)
     amp_mat.row_attr_map = row_attr_map
 
     # testing
@@ -139,14 +290,19 @@ def do_AmpliconMatrix_workflow():
     log_flpth = os.path.join(Var.return_dir, 'log.txt')
     cmd_flpth = os.path.join(Var.return_dir, 'cmd.txt')
 
-    taxon_table_flpth = os.path.join(Var.return_dir, 'otu_table.tsv')
-    amp_mat.to_OTU_table(tax_l, taxon_table_flpth)
+    # with `collapse_table.py`, stream the OTU table through stdin rather than a file
+    stream = Var.params.getd('faprotax_engine') == 'subprocess' and Var.params.getd('stream_otu_table')
+
+    if stream:
+        taxon_table_flpth = '/dev/stdin'
+    else:
+        taxon_table_flpth = os.path.join(Var.return_dir, 'otu_table.tsv')
+        amp_mat.write_OTU_table(tax_l, taxon_table_flpth)
 
     Var.out_dir = os.path.join(Var.return_dir, 'FAPROTAX_output')
     sub_tables_dir = os.path.join(Var.out_dir, 'sub_tables')
 
     os.mkdir(Var.out_dir)
-    os.mkdir(sub_tables_dir)
 
     collapsed_func_table_flpth = os.path.join(Var.out_dir, 'collapsed_func_table.tsv')
     report_flpth = os.path.join(Var.out_dir, 'report.txt')
@@ -174,9 +330,6 @@ def do_AmpliconMatrix_workflow():
         '|& tee', log_flpth
         ])
 
-    with open(cmd_flpth, 'w') as f:
-        f.write(cmd)
-
 
 
     #
@@ -185,7 +338,35 @@ def do_AmpliconMatrix_workflow():
     ####
     #####
 
-    run_check(cmd)
+    if Var.params.getd('faprotax_engine') == 'subprocess':
+        os.mkdir(sub_tables_dir)
+        with open(cmd_flpth, 'w') as f:
+            if stream:
+                f.write(
+                    '# The OTU table was piped to stdin and not kept. '
+                    'To re-run, write it to a file and pass that as `--input_table`\n')
+            f.write(cmd)
+
+        if stream:
+            run_check(cmd, stdin_chunks=amp_mat.iter_OTU_table(tax_l))
+        else:
+            run_check(cmd)
+
+        result = FaprotaxResult.from_outputs(collapsed_func_table_flpth, groups2records_table_flpth)
+
+    else:
+        result = run_native(tax_l, amp_mat.get_values(), amp_mat.obj['data']['col_ids'])
+
+    keep_dense_groups2records = True
+    if Var.params.getd('sparse_groups2records') is not None:
+        keep_dense_groups2records = export_sparse_groups2records(result, Var.params.getd('sparse_groups2records'))
+
+    if Var.params.getd('faprotax_engine') == 'native':
+        write_native_outputs(
+            result, amp_mat.get_values(), skip=[] if keep_dense_groups2records else ['groups2records'])
+
+    if Var.params.getd('export_format') == 'parquet':
+        export_parquet(result, amp_mat.get_values(), row_ids=id_l)
 
 
 
@@ -203,86 +384,116 @@ def do_AmpliconMatrix_workflow():
     attribute = 'FAPROTAX Functions (taxonomy=<%s>)' % Var.params['tax_field']
     source = 'FAPROTAX'    
 
-    '''
-    tax2groups = parse_tax2groups(groups2records_table_dense_flpth)
-    id2groups = {id: tax for id, (tax, groups) in zip(id_l, tax2groups.items())}
-    '''
-    tax_order, groups_l = parse_tax2groups(groups2records_table_dense_flpth)
-    id2groups = {id: group for id, group in zip(id_l, groups_l)}
+    groups_l = result.get_groups_l() # in `id_l` order
 
     # 99% sure FAPROTAX did not reorder the rows of OTU table
     # from running it and checking source code
     if Var.debug: 
-        assert tax_order == tax_l, '`%s`\n`%s`' % (tax_order, tax_l)
+        assert result.records == tax_l, '`%s`\n`%s`' % (result.records, tax_l)
 
     ind, attribute = row_attr_map.add_attribute_slot(attribute, source)
-    row_attr_map.map_update_attribute(ind, id2groups)
-    row_attr_map_upa_new = row_attr_map.save()
+    row_attr_map.update_attribute(ind, groups_l)
 
-    amp_mat.obj['row_attributemapping_ref'] = row_attr_map_upa_new
     amp_mat.name = Var.params['output_amplicon_matrix_name']
-    amp_mat_upa_new = amp_mat.save()
-
-    Var.objects_created = [
-        {
-            'ref': row_attr_map_upa_new, 
-            'description': 'Added attribute `%s`' % attribute.replace('<', '&lt;').replace('>', '&gt;')
-        }, 
-        {
-            'ref': amp_mat_upa_new, 
-            'description': 'Updated row AttributeMapping reference to `%s`' % row_attr_map_upa_new
-        },
-    ]
 
 
     #
     ##
-    ### make FunctionalProfiles
+    ### save objects, make FunctionalProfiles, report
     ####
     #####
 
-    ### Amplicon FP ###
+    # Remote calls run concurrently as dependencies allow:
+    # AttributeMapping save -> AmpliconMatrix save -> both FunctionalProfile imports -> report
 
-    # map groups2records back to groups2ids
     groups2ids_table_flpth = os.path.join(Var.run_dir, 'groups2ids.tsv')
-    map_groups2records_to_groups2ids(groups2records_table_flpth, groups2ids_table_flpth, id_l)
-
-    func_prof_amplicon_upa = Var.fpu.import_func_profile(dict(
-        workspace_id=Var.params['workspace_id'],
-        func_profile_obj_name='%s.groups2records' % amp_mat.name,
-        original_matrix_ref=amp_mat_upa_new,
-        profile_file_path=groups2ids_table_flpth,
-        profile_type='amplicon',
-        profile_category='organism',
-        data_epistemology='predicted',
-        epistemology_method='FAPROTAX',
-        description='Amplicon functional profile',
-    ))['func_profile_ref']
 
-    Var.objects_created.append(
-        dict(ref=func_prof_amplicon_upa, description='Amplicon functions')
-    )
+    def save_row_attr_map():
+        return row_attr_map.save()
 
+    def save_amp_mat(row_attr_map_upa_new):
+        amp_mat.obj['row_attributemapping_ref'] = row_attr_map_upa_new
+        return amp_mat.save()
 
-    ### Metagenome FP ###
-
-    func_prof_sample_upa = Var.fpu.import_func_profile(dict(
-        workspace_id=Var.params['workspace_id'],
-        func_profile_obj_name='%s.collapsed_func_table' % amp_mat.name,
-        original_matrix_ref=amp_mat_upa_new, 
-        profile_file_path=collapsed_func_table_flpth,
-        profile_type='mg',
-        profile_category='community',
-        data_epistemology='predicted',
-        epistemology_method='FAPROTAX',
-        description='Sample functional profile'
-    ))['func_profile_ref']
+    ### Amplicon FP ###
 
+    def write_groups2ids():
+        # map groups2records back to groups2ids
+        map_groups2records_to_groups2ids(result, groups2ids_table_flpth, id_l)
+
+    def import_func_prof_amplicon(amp_mat_upa_new, _):
+        return Var.fpu.import_func_profile(dict(
+            workspace_id=Var.params['workspace_id'],
+            func_profile_obj_name='%s.groups2records' % amp_mat.name,
+            original_matrix_ref=amp_mat_upa_new,
+            profile_file_path=groups2ids_table_flpth,
+            profile_type='amplicon',
+            profile_category='organism',
+            data_epistemology='predicted',
+            epistemology_method='FAPROTAX',
+            description='Amplicon functional profile',
+        ))['func_profile_ref']
 
-    Var.objects_created.append(
-        dict(ref=func_prof_sample_upa, description='Sample functions')
-    )
+    ### Metagenome FP ###
 
+    def import_func_prof_sample(amp_mat_upa_new):
+        return Var.fpu.import_func_profile(dict(
+            workspace_id=Var.params['workspace_id'],
+            func_profile_obj_name='%s.collapsed_func_table' % amp_mat.name,
+            original_matrix_ref=amp_mat_upa_new, 
+            profile_file_path=collapsed_func_table_flpth,
+            profile_type='mg',
+            profile_category='community',
+            data_epistemology='predicted',
+            epistemology_method='FAPROTAX',
+            description='Sample functional profile'
+        ))['func_profile_ref']
+
+    ### Report ###
+
+    def create_report(row_attr_map_upa_new, amp_mat_upa_new, func_prof_amplicon_upa, func_prof_sample_upa):
+        Var.objects_created = [
+            {
+                'ref': row_attr_map_upa_new, 
+                'description': 'Added attribute `%s`' % attribute.replace('<', '&lt;').replace('>', '&gt;')
+            }, 
+            {
+                'ref': amp_mat_upa_new, 
+                'description': 'Updated row AttributeMapping reference to `%s`' % row_attr_map_upa_new
+            },
+            dict(ref=func_prof_amplicon_upa, description='Amplicon functions'),
+            dict(ref=func_prof_sample_upa, description='Sample functions'),
+        ]
+
+        file_links = [{
+            'path': Var.return_dir, 
+            'name': 'faprotax_results.zip',
+            'description': 'Input, output, logs to FAPROTAX run'
+            }]
+
+
+        params_report = {
+            'warnings': Var.warnings,
+            'objects_created': Var.objects_created,
+            'file_links': file_links,
+            'report_object_name': 'kb_faprotax_report',
+            'workspace_id': Var.params['workspace_id'],
+            }
+
+        Var.params_report = DotMap(params_report) # testing
+
+        return Var.kbr.create_extended_report(params_report)
+
+    results = run_tasks({
+        'save_row_attr_map': (save_row_attr_map, []),
+        'save_amp_mat': (save_amp_mat, ['save_row_attr_map']),
+        'write_groups2ids': (write_groups2ids, []),
+        'import_func_prof_amplicon': (import_func_prof_amplicon, ['save_amp_mat', 'write_groups2ids']),
+        'import_func_prof_sample': (import_func_prof_sample, ['save_amp_mat']),
+        'create_report': (create_report, [
+            'save_row_attr_map', 'save_amp_mat', 'import_func_prof_amplicon', 'import_func_prof_sample']),
+    })
+    report_output = results['create_report']
 
 
     #
@@ -291,26 +502,6 @@ def do_AmpliconMatrix_workflow():
     ####
     #####
 
-
-    file_links = [{
-        'path': Var.return_dir, 
-        'name': 'faprotax_results.zip',
-        'description': 'Input, output, logs to FAPROTAX run'
-        }]
-
-
-    params_report = {
-        'warnings': Var.warnings,
-        'objects_created': Var.objects_created,
-        'file_links': file_links,
-        'report_object_name': 'kb_faprotax_report',
-        'workspace_id': Var.params['workspace_id'],
-        }
-
-    Var.params_report = DotMap(params_report) # testing
-
-    report_output = Var.kbr.create_extended_report(params_report)
-
     output = {
         'report_name': report_output['name'],
         'report_ref': report_output['ref'],
@@ -355,7 +546,6 @@ def do_GenomeSet_workflow():
     # and not are not necessary
 
     otu_table_flpth = os.path.join(Var.return_dir, 'otu_table.tsv')
-    gs.to_OTU_table(otu_table_flpth)
 
     log_flpth = os.path.join(Var.return_dir, 'log.txt')
     cmd_flpth = os.path.join(Var.return_dir, 'cmd.txt')
@@ -364,7 +554,6 @@ def do_GenomeSet_workflow():
     sub_tables_dir = os.path.join(Var.out_dir, 'sub_tables')
 
     os.mkdir(Var.out_dir)
-    os.mkdir(sub_tables_dir)
 
     collapsed_func_table_flpth = os.path.join(Var.out_dir, 'collapsed_func_table.tsv')
     report_flpth = os.path.join(Var.out_dir, 'report.txt')
@@ -391,9 +580,6 @@ def do_GenomeSet_workflow():
         '|& tee', log_flpth
     ])
 
-    with open(cmd_flpth, 'w') as f:
-        f.write(cmd)
-
 
 
     #
@@ -402,7 +588,20 @@ def do_GenomeSet_workflow():
     ####
     #####
 
-    run_check(cmd)
+    if Var.params.getd('faprotax_engine') == 'subprocess':
+        gs.to_OTU_table(otu_table_flpth)
+        os.mkdir(sub_tables_dir)
+        with open(cmd_flpth, 'w') as f:
+            f.write(cmd)
+
+        run_check(cmd)
+
+        result = FaprotaxResult.from_outputs(collapsed_func_table_flpth, groups2records_table_flpth)
+
+    else:
+        # no output files, since the report doesn't upload `Var.return_dir`
+        tax_l = gs.df['taxonomy'].tolist()
+        result = run_native(tax_l, np.ones((len(tax_l), 1)), ['dummy_sample'])
 
 
 
@@ -415,7 +614,7 @@ def do_GenomeSet_workflow():
     #####
 
 
-    tax2groups = parse_faprotax_functions(groups2records_table_dense_flpth, dlm=', ') # parse FAPROTAX results
+    tax2groups = result.get_tax2groups(dlm=', ')
 
     gs.df['functions'] = gs.df.apply(lambda row: tax2groups.get(row['taxonomy'], np.nan), axis=1) # stitch FAPROTAX results onto GenomeSet df
 
@@ -38,6 +38,7 @@ class TestCase(cfg.BaseTest):
                 'input_upa': enigma50by30_RDPClsf,
                 'tax_field': 'RDP Classifier taxonomy, conf=0.777, gene=silva_138_ssu, minWords=default',
                 'output_amplicon_matrix_name': 'a_name',
+                'faprotax_engine': 'subprocess',
             }
         )
 
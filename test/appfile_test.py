@@ -32,13 +32,15 @@ import config
 ####################################################################################################
 ####################################################################################################
 def test_parse_faprotax_functions():
-    '''Test function used to parse FAPROTAX's predicted functions from its output'''
-    from kb_faprotax.util.workflow import parse_faprotax_functions
+    '''Test parsing FAPROTAX's predicted functions from its output'''
+    from kb_faprotax.util.engine import FaprotaxResult
 
-    flnm = 'groups2records_dense.tsv'
-    flpth = os.path.join(testData_dir, 'by_dataset_input/refseq/return/FAPROTAX_output', flnm)
+    out_dir = os.path.join(testData_dir, 'by_dataset_input/refseq/return/FAPROTAX_output')
     
-    r2g_d = parse_faprotax_functions(flpth)
+    r2g_d = FaprotaxResult.from_outputs(
+        os.path.join(out_dir, 'collapsed_func_table.tsv'),
+        os.path.join(out_dir, 'groups2records.tsv'),
+    ).get_tax2groups()
 
     taxonomy = '\
 cellular organisms; Bacteria; Proteobacteria; Gammaproteobacteria; Pseudomonadales; Moraxellaceae; \
@@ -0,0 +1,49 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+from kb_faprotax.util import engine
+from kb_faprotax.util.cache import TaxonomyCache
+from kb_faprotax.util.database import FaprotaxDB
+from kb_faprotax.util.engine import assign_groups
+from mock import * # mock business
+
+
+####################################################################################################
+####################################################################################################
+def test_TaxonomyCache():
+    flpth = os.path.join(tempfile.mkdtemp(), 'memo.sqlite')
+    cache = TaxonomyCache(flpth, max_entries=3)
+
+    cache.put_many('hash0', {'A;B': ['g0', 'g1'], 'A;C': []})
+    assert cache.get_many('hash0', ['a;b', 'A;B', 'A;C', 'A;D']) == {'a;b': ['g0', 'g1'], 'A;B': ['g0', 'g1'], 'A;C': []}
+    assert cache.get_many('hash1', ['A;B']) == {} # keyed by database
+
+    # least recently used is evicted
+    cache.get_many('hash0', ['A;B'])
+    cache.put_many('hash0', {'A;D': ['g2'], 'A;E': ['g3']})
+    assert len(cache) == 3
+    assert cache.get_many('hash0', ['A;B', 'A;C', 'A;D', 'A;E']).keys() == {'A;B', 'A;D', 'A;E'}
+
+    # persists
+    cache.close()
+    assert TaxonomyCache(flpth).get_many('hash0', ['A;E']) == {'A;E': ['g3']}
+
+
+####################################################################################################
+####################################################################################################
+def test_assign_groups_cache():
+    db = FaprotaxDB.compile(write_mock_db())
+    cache = TaxonomyCache(os.path.join(tempfile.mkdtemp(), 'memo.sqlite'))
+    records = ['Bacteria;Proteobacteria;Nitrosomonas', 'Bacteria;Nitrospira', 'Bacteria;Firmicutes']
+
+    membership = assign_groups(db, records, cache=cache)
+    assert cache.get_many(db.hash, records) == {
+        'Bacteria;Proteobacteria;Nitrosomonas': ['nitrification', 'aerobic', 'obligate_aerobic_and_others', 'aerobic_nitrifiers'],
+        'Bacteria;Nitrospira': ['nitrification', 'aerobic', 'obligate_aerobic_and_others', 'aerobic_nitrifiers'],
+        'Bacteria;Firmicutes': [],
+    }
+
+    # warm run skips matching
+    with patch.object(engine, 'get_matcher', side_effect=AssertionError):
+        assert (assign_groups(db, records, cache=cache) == membership).all()
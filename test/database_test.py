@@ -0,0 +1,127 @@
+import os
+import pickle
+import random
+import numpy as np
+from pytest import raises
+
+from kb_faprotax.util import database
+from kb_faprotax.util.database import parse_groups_file, parse_metadata, FaprotaxDB, load_db, get_compiled_flpth
+from kb_faprotax.util.database import pack_bits, unpack_bits
+from kb_faprotax.util.matcher import TaxonMatcher
+from kb_faprotax.util.error import DatabaseParseException
+from mock import * # mock business
+
+
+####################################################################################################
+####################################################################################################
+def test_parse_groups_file():
+    groups = parse_groups_file(write_mock_db())
+
+    assert [group['name'] for group in groups] == [
+        'nitrification', 'aerobic', 'anaerobic', 'obligate_aerobic_and_others', 'aerobic_nitrifiers']
+    assert groups[0]['metadata'] == 'elements:N; aerobic:yes'
+    assert groups[0]['ops'] == [
+        ('member', '*Proteobacteria*Nitrosomonas*'), ('member', '*Nitrospira*'), ('member', '*Nitrobacter*')]
+    assert groups[3]['ops'][1] == ('subtract_group', 'anaerobic')
+
+    with raises(DatabaseParseException, match='before it is defined'):
+        parse_groups_file(write_mock_db('first\nadd_group:second\n\nsecond\n*A*\n'))
+
+    assert parse_metadata('elements:C, H; aerobic:no;') == {'elements': ['C', 'H'], 'aerobic': ['no']}
+
+
+####################################################################################################
+####################################################################################################
+def test_FaprotaxDB_compile():
+    db = FaprotaxDB.compile(write_mock_db())
+
+    assert db.num_groups == 5
+    assert db.metadata[0] == {'elements': ['N'], 'aerobic': ['yes']}
+    assert db.patterns.count('*Nitrospira*') == 1 # shared members interned once
+    assert [db.tokens[i] for i in db.pattern_tokens[0]] == ['', 'proteobacteria', 'nitrosomonas', '']
+    assert db.ops[3] == [('add_group', 1), ('subtract_group', 2), ('member', 5)]
+    assert db.deps[3] == [1, 2]
+    assert [(op, arg.tolist() if op == 'members' else arg) for op, arg in db.programs[0]] == [('members', [0, 1, 2])]
+    assert db.metadata_index['aerobic'] == {'yes': [0, 1], 'no': [2]}
+    assert db.get_definition(4) == 'aerobic_nitrifiers\t\nadd_group:nitrification\nintersect_group:aerobic\n'
+
+
+####################################################################################################
+####################################################################################################
+def test_load_db():
+    flpth = write_mock_db()
+    compiled_flpth = get_compiled_flpth(flpth)
+
+    # compiles and stores
+    db = load_db(flpth)
+    assert os.path.exists(compiled_flpth)
+
+    # loads compiled without parsing
+    with patch.object(database, 'parse_groups_file', side_effect=AssertionError):
+        assert load_db(flpth).group_names == db.group_names
+
+    # rebuilds when text changes
+    with open(flpth, 'a') as fh:
+        fh.write('\nnew_group\n*Firmicutes*\n')
+    db_new = load_db(flpth)
+    assert db_new.group_names[-1] == 'new_group'
+    assert db_new.hash != db.hash
+    with open(compiled_flpth, 'rb') as fh:
+        assert pickle.load(fh)['hash'] == db_new.hash
+
+    # shipped database
+    db = FaprotaxDB.compile(Var.db_flpth)
+    assert len(db.group_names) == len(set(db.group_names))
+    assert 'aerobic_chemoheterotrophy' in db.group_names
+
+
+####################################################################################################
+####################################################################################################
+def test_bits():
+    rng = np.random.RandomState(0)
+    for num_records in [0, 1, 63, 64, 65, 200]:
+        a = rng.rand(3, num_records) < 0.3
+        bits = pack_bits(a)
+        assert bits.dtype == np.uint64
+        assert bits.shape == (3, (num_records + 63) // 64)
+        assert np.array_equal(unpack_bits(bits, num_records), a)
+
+
+####################################################################################################
+####################################################################################################
+def test_FaprotaxDB_resolve():
+    '''
+    Bitset resolution should agree with applying each group's ops in order, record by record
+    '''
+    db = FaprotaxDB.compile(Var.db_flpth)
+    matcher = TaxonMatcher(db)
+
+    rng = random.Random(1)
+    records = get_pattern_records(
+        db, rng.sample(range(len(db.patterns)), 500), extra=['Bacteria;Firmicutes;Clostridia', ''])
+
+    pattern_inds, record_inds = matcher.match_patterns_many(records)
+    membership = unpack_bits(db.resolve(pattern_inds, record_inds, len(records)), len(records))
+
+    for j, record in enumerate(records):
+        assert np.flatnonzero(membership[:, j]).tolist() == matcher.match_groups(record), record
+
+
+####################################################################################################
+####################################################################################################
+def test_FaprotaxDB_select_groups():
+    db = FaprotaxDB.compile(write_mock_db())
+
+    assert db.select_groups({'aerobic': 'yes'}) == [0, 1]
+    assert db.select_groups({'aerobic': ['yes', 'no']}) == [0, 1, 2]
+    assert db.select_groups({'aerobic': 'yes', 'elements': 'N'}) == [0]
+    assert db.select_groups({'elements': 'S'}) == []
+    assert db.select_groups({'nonexistent_key': 'yes'}) == []
+
+    assert db.get_closure([3]) == [1, 2, 3]
+    assert db.get_closure([4, 2]) == [0, 1, 2, 4]
+    assert db.get_patterns([1, 2]) == [1, 3, 4]
+
+    db = FaprotaxDB.compile(Var.db_flpth)
+    nitrogen = [db.group_names[i] for i in db.select_groups({'elements': 'N'})]
+    assert 'nitrification' in nitrogen and 'methanogenesis' not in nitrogen
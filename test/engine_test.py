@@ -0,0 +1,361 @@
+import os
+import gzip
+import tempfile
+import numpy as np
+import pandas as pd
+import scipy.io
+from scipy import sparse
+from pytest import raises
+
+from kb_faprotax.util.engine import factorize_records, assign_groups, build_membership, collapse, collapse_table
+from kb_faprotax.util.engine import group_overlaps, write_outputs, write_parquet_outputs, write_sparse_membership
+from kb_faprotax.util.engine import FaprotaxResult, get_cgroup_cpu_quota, get_num_workers
+from kb_faprotax.util.database import FaprotaxDB, get_db
+from kb_faprotax.util.cache import TaxonomyCache
+from kb_faprotax.util.error import ValidationException
+from mock import * # mock business
+
+
+####################################################################################################
+####################################################################################################
+def test_factorize_records():
+    uniq_l, inverse = factorize_records(['a;b', 'a;c', None, 'a;b', '', 'a;c'])
+
+    assert uniq_l == ['a;b', 'a;c', '']
+    assert inverse.tolist() == [0, 1, 2, 0, 2, 1]
+
+
+####################################################################################################
+####################################################################################################
+def test_assign_groups():
+    db = FaprotaxDB.compile(write_mock_db())
+    records = [
+        'Bacteria;Proteobacteria;Betaproteobacteria;Nitrosomonadales;Nitrosomonadaceae;Nitrosomonas',
+        'Bacteria;Proteobacteria;Deltaproteobacteria;Desulfovibrionales;Desulfovibrionaceae;Desulfovibrio',
+        'Bacteria;Proteobacteria;Deltaproteobacteria;Myxococcales',
+        'bacteria;nitrospirae;NITROSPIRA',
+        'Bacteria;Firmicutes',
+        None,
+    ]
+
+    membership = assign_groups(db, records)
+
+    assert membership.tolist() == [
+        [True, False, False, True, False, False], # nitrification, case insensitive
+        [True, True, True, True, False, False], # aerobic
+        [False, True, True, False, False, False], # anaerobic
+        [True, True, False, True, False, False], # subtraction only applies to ops before it
+        [True, False, False, True, False, False], # intersection
+    ]
+
+
+####################################################################################################
+####################################################################################################
+def test_collapse():
+    membership_uniq = np.array([[True, False], [True, True], [False, False]]) # groups x distinct records
+    inverse = np.array([0, 1, 1, 0, 1])
+
+    membership = build_membership(membership_uniq, inverse)
+
+    assert membership.shape == (3, 5)
+    assert membership.toarray().tolist() == [[1, 0, 0, 1, 0], [1, 1, 1, 1, 1], [0, 0, 0, 0, 0]]
+
+    data = [[1, 2], [3, None], [5, 6], [7, 8], [9, 10]]
+    collapsed = collapse(membership, data)
+    assert collapsed.tolist() == [[8, 10], [25, 26], [0, 0]]
+
+    collapsed = collapse(membership, data, dtype=np.float32)
+    assert collapsed.dtype == np.float32
+    assert collapsed.tolist() == [[8, 10], [25, 26], [0, 0]]
+
+    # sample blocks, including a ragged last block
+    data = np.arange(5 * 7, dtype=float).reshape(5, 7)
+    data[1, 3] = np.nan
+    for block_size in [1, 3, 7, 100]:
+        collapsed = collapse(membership, data, block_size=block_size)
+        assert np.array_equal(collapsed, collapse(membership, data))
+
+
+####################################################################################################
+####################################################################################################
+def test_group_overlaps():
+    membership = np.array([[1, 1, 0, 1], [0, 1, 1, 1], [0, 0, 0, 0]], dtype=bool)
+    abundance = [1, 10, 100, np.nan]
+
+    overlaps_df, weighted_overlaps_df = group_overlaps(membership, abundance, ['a', 'b', 'c'])
+
+    assert overlaps_df.values.tolist() == [[3, 2, 0], [2, 3, 0], [0, 0, 0]]
+    assert weighted_overlaps_df.values.tolist() == [[11, 10, 0], [10, 110, 0], [0, 0, 0]]
+    assert overlaps_df.index.tolist() == overlaps_df.columns.tolist() == ['a', 'b', 'c']
+
+
+####################################################################################################
+####################################################################################################
+def test_collapse_table():
+    db_flpth = write_mock_db()
+    tax_l = ['Bacteria;Proteobacteria;Nitrosomonas', 'Bacteria;Nitrospira', 'Bacteria;Firmicutes', 'Bacteria;Nitrospira']
+    data = [[1, 2], [10, None], [100, 200], [1000, 1000]]
+
+    result = collapse_table(tax_l, data, ['s1', 's2'], db_flpth=db_flpth)
+    collapsed_df, g2r_df, groups_l = result.collapsed_df, result.get_g2r_df(), result.get_groups_l()
+
+    assert collapsed_df.loc['nitrification'].tolist() == [1011, 1002]
+    assert collapsed_df.loc['aerobic'].tolist() == [1011, 1002]
+    assert collapsed_df.loc['anaerobic'].tolist() == [0, 0]
+    assert g2r_df['record'].tolist() == tax_l
+    assert g2r_df['aerobic_nitrifiers'].tolist() == [1, 1, 0, 1]
+    assert groups_l == [
+        'nitrification,aerobic,obligate_aerobic_and_others,aerobic_nitrifiers',
+        'nitrification,aerobic,obligate_aerobic_and_others,aerobic_nitrifiers',
+        '',
+        'nitrification,aerobic,obligate_aerobic_and_others,aerobic_nitrifiers',
+    ]
+
+    out_dir = tempfile.mkdtemp()
+    write_outputs(out_dir, result, data, db_flpth=db_flpth)
+
+    for flnm in ['collapsed_func_table.tsv', 'groups2records.tsv', 'groups2records_dense.tsv',
+                 'native_group_overlaps.tsv', 'native_group_overlaps_weighted.tsv', 'native_group_definitions_used.txt',
+                 'native_report.txt', 'native_sub_tables/aerobic.tsv']:
+        assert os.path.exists(os.path.join(out_dir, flnm))
+    assert not os.path.exists(os.path.join(out_dir, 'native_sub_tables/anaerobic.tsv'))
+
+    # parsed back from files, as for `collapse_table.py` outputs
+    result_parsed = FaprotaxResult.from_outputs(
+        os.path.join(out_dir, 'collapsed_func_table.tsv'), os.path.join(out_dir, 'groups2records.tsv'))
+    assert result_parsed.records == tax_l
+    assert result_parsed.group_names == result.group_names
+    assert (result_parsed.membership != result.membership).nnz == 0
+    assert np.allclose(result_parsed.collapsed_df.values, collapsed_df.values)
+    assert result_parsed.get_groups_l(dlm=', ') == [groups.replace(',', ', ') for groups in groups_l]
+
+    # selected outputs only, others on request
+    out_dir = tempfile.mkdtemp()
+    writer = write_outputs(out_dir, result, data, db_flpth=db_flpth, artifacts=['report'])
+
+    assert sorted(os.listdir(out_dir)) == ['collapsed_func_table.tsv', 'native_report.txt']
+    assert writer.get_flpth('sub_tables') == os.path.join(out_dir, 'native_sub_tables')
+    assert os.listdir(os.path.join(out_dir, 'native_sub_tables'))
+
+
+####################################################################################################
+####################################################################################################
+def test_collapse_table_parity():
+    '''
+    Native engine should reproduce `collapse_table.py`'s outputs kept in the test data,
+    which the mock `run_check` copies in for the subprocess engine
+    Only these outputs are written under `collapse_table.py`'s names, see `OutputWriter.ARTIFACTS`
+    '''
+    for dataset in ['enigma50by30', 'enigma17770by511']:
+        return_dir = os.path.join(testData_dir, 'by_dataset_input', dataset, 'return')
+        out_dir = os.path.join(return_dir, 'FAPROTAX_output')
+
+        otu_df = pd.read_csv(os.path.join(return_dir, 'otu_table.tsv'), sep='\t', index_col='taxonomy')
+        tax_l = [None if pd.isna(tax) else tax for tax in otu_df.index]
+        data = otu_df.iloc[:, 1:] # `OTU_Id` omitted, as with `--omit_columns 1`
+
+        result = collapse_table(tax_l, data.values, data.columns.tolist())
+        result_subprocess = FaprotaxResult.from_outputs(
+            os.path.join(out_dir, 'collapsed_func_table.tsv'), os.path.join(out_dir, 'groups2records.tsv'))
+
+        # collapsed_func_table.tsv
+        assert result.collapsed_df.index.tolist() == result_subprocess.collapsed_df.index.tolist(), dataset
+        assert result.collapsed_df.columns.tolist() == result_subprocess.collapsed_df.columns.tolist(), dataset
+        assert np.allclose(result.collapsed_df.values, result_subprocess.collapsed_df.values), dataset
+
+        # groups2records.tsv
+        assert ['' if tax is None else tax for tax in result.records] == result_subprocess.records, dataset
+        assert result.group_names == result_subprocess.group_names, dataset
+        assert (result.membership != result_subprocess.membership).nnz == 0, dataset
+
+        # groups2records_dense.tsv
+        dense_df = pd.read_csv(
+            os.path.join(out_dir, 'groups2records_dense.tsv'), sep='\t', comment='#').fillna('').drop_duplicates()
+        tax2groups = result.get_tax2groups()
+        tax2groups = {'' if tax is None else tax: groups for tax, groups in tax2groups.items()}
+        assert [tax2groups[tax] for tax in dense_df['record']] == dense_df['group'].tolist(), dataset
+
+
+####################################################################################################
+####################################################################################################
+def test_collapse_table_group_filter():
+    '''
+    Restricted runs should give the same rows as full runs for the selected groups
+    '''
+    db = get_db(Var.db_flpth)
+    tax_l = get_pattern_records(db, range(0, len(db.patterns), 10))
+    data = np.arange(len(tax_l) * 2).reshape(-1, 2)
+
+    result = collapse_table(tax_l, data, ['s1', 's2'])
+    result_N = collapse_table(tax_l, data, ['s1', 's2'], group_filter={'elements': 'N'})
+    collapsed_df, g2r_df, groups_l = result.collapsed_df, result.get_g2r_df(), result.get_groups_l()
+    collapsed_df_N, g2r_df_N, groups_l_N = result_N.collapsed_df, result_N.get_g2r_df(), result_N.get_groups_l()
+
+    nitrogen = [db.group_names[i] for i in db.select_groups({'elements': 'N'})]
+    assert collapsed_df_N.index.tolist() == nitrogen
+    assert collapsed_df_N.equals(collapsed_df.loc[nitrogen])
+    assert g2r_df_N.equals(g2r_df[['record'] + nitrogen])
+    assert groups_l_N == [
+        ','.join(group for group in groups.split(',') if group in nitrogen) for groups in groups_l]
+
+    with raises(ValidationException, match='No FAPROTAX groups'):
+        collapse_table(tax_l, data, ['s1', 's2'], group_filter={'elements': 'Unobtainium'})
+
+
+####################################################################################################
+####################################################################################################
+def test_FaprotaxResult_membership_tsv():
+    '''
+    Streamed membership TSV should be what the DataFrame would write
+    '''
+    db = get_db(Var.db_flpth)
+    tax_l = get_pattern_records(db, range(0, len(db.patterns), 7))
+    result = collapse_table(tax_l, np.ones((len(tax_l), 1)), ['s1'])
+
+    g2r_df = result.get_g2r_df()
+    assert ''.join(result.iter_membership_tsv(chunk_size=9)) == g2r_df.to_csv(sep='\t', index=False)
+    assert result.get_membership_tsv_size() == len(g2r_df.to_csv(sep='\t', index=False).encode())
+
+    id_l = ['amplicon_%d' % i for i in range(len(tax_l))]
+    df = g2r_df.drop('record', axis=1)
+    df.index = id_l
+    df.index.name = 'id'
+    flpth = os.path.join(tempfile.mkdtemp(), 'groups2ids.tsv')
+    result.write_membership_tsv(flpth, row_ids=id_l, index_name='id', chunk_size=4)
+    with open(flpth) as fh:
+        assert fh.read() == df.to_csv(sep='\t')
+    assert result.get_membership_tsv_size(row_ids=id_l, index_name='id') == os.path.getsize(flpth)
+
+
+####################################################################################################
+####################################################################################################
+def test_write_parquet_outputs():
+    db_flpth = write_mock_db()
+    tax_l = [
+        'Bacteria;Proteobacteria;Betaproteobacteria;Nitrosomonadales;Nitrosomonas',
+        'Bacteria;Nitrospirae;Nitrospira',
+        None,
+        'Bacteria;Proteobacteria;Deltaproteobacteria;Desulfovibrionales;Desulfovibrio',
+    ]
+    data = np.array([[1, 2], [10, 0], [5, 5], [np.nan, 7]])
+    result = collapse_table(tax_l, data, ['s1', 's2'], db_flpth=db_flpth)
+
+    out_dir = tempfile.mkdtemp()
+    write_outputs(out_dir, result, data, db_flpth=db_flpth)
+    flpths = write_parquet_outputs(out_dir, result, data, row_ids=['a0', 'a1', 'a2', 'a3'])
+    assert sorted(os.path.basename(flpth) for flpth in flpths) == [
+        'collapsed_func_table.parquet', 'groups2records.parquet', 'otu_table.parquet', 'sub_tables.parquet']
+
+    otu_df = pd.read_parquet(os.path.join(out_dir, 'otu_table.parquet'))
+    assert otu_df.columns.tolist() == ['taxonomy', 'OTU_Id', 's1', 's2']
+    assert otu_df['OTU_Id'].tolist() == ['a0', 'a1', 'a2', 'a3']
+
+    collapsed_df = pd.read_parquet(os.path.join(out_dir, 'collapsed_func_table.parquet')).set_index('group')
+    assert np.allclose(collapsed_df.values, result.collapsed_df.values)
+
+    g2r_df = pd.read_parquet(os.path.join(out_dir, 'groups2records.parquet'))
+    assert g2r_df.drop('record', axis=1).values.tolist() == result.get_g2r_df().drop('record', axis=1).values.tolist()
+
+    # long sub tables match the TSV tree
+    sub_df = pd.read_parquet(os.path.join(out_dir, 'sub_tables.parquet'))
+    for flnm in os.listdir(os.path.join(out_dir, 'native_sub_tables')):
+        group = flnm[:-len('.tsv')]
+        tsv_df = pd.read_csv(os.path.join(out_dir, 'native_sub_tables', flnm), sep='\t')
+        long_df = sub_df[sub_df['group'] == group].drop('group', axis=1).reset_index(drop=True)
+        assert long_df['record'].tolist() == tsv_df['record'].tolist()
+        assert np.allclose(long_df[['s1', 's2']].values, tsv_df[['s1', 's2']].values, equal_nan=True)
+    sub_tables_dir = os.path.join(out_dir, 'native_sub_tables')
+    assert set(sub_df['group']) == {flnm[:-len('.tsv')] for flnm in os.listdir(sub_tables_dir)}
+
+
+####################################################################################################
+####################################################################################################
+def test_write_sparse_membership():
+    db = get_db(Var.db_flpth)
+    tax_l = get_pattern_records(db, range(0, len(db.patterns), 7))
+    result = collapse_table(tax_l, np.ones((len(tax_l), 1)), ['s1'])
+    g2r = result.get_g2r_df().drop('record', axis=1).values
+
+    out_dir = tempfile.mkdtemp()
+    flpths = write_sparse_membership(out_dir, result, fmt='npz')
+    assert [os.path.basename(flpth) for flpth in flpths] == [
+        'groups2records.npz', 'groups2records.rows.txt.gz', 'groups2records.cols.txt']
+    assert np.array_equal(sparse.load_npz(flpths[0]).toarray(), g2r)
+    with gzip.open(flpths[1], 'rt') as fh:
+        assert fh.read().split('\n')[:-1] == [tax if tax is not None else '' for tax in tax_l]
+    with open(flpths[2]) as fh:
+        assert fh.read().split('\n')[:-1] == result.group_names
+
+    flpths = write_sparse_membership(out_dir, result, fmt='mtx')
+    assert np.array_equal(scipy.io.mmread(flpths[0]).toarray(), g2r)
+
+    # much smaller than dense, labels included
+    flpths = write_sparse_membership(out_dir, result, fmt='npz')
+    assert sum(os.path.getsize(flpth) for flpth in flpths) * 4 < result.get_membership_tsv_size()
+
+
+####################################################################################################
+####################################################################################################
+def test_collapse_table_sharded():
+    '''
+    Sharding distinct taxonomies across processes should give the same result as one process
+    '''
+    db = get_db(Var.db_flpth)
+    rng = np.random.RandomState(0)
+    tax_l = get_pattern_records(db, rng.choice(len(db.patterns), 300), extra=[None, 'Bacteria;Firmicutes'] * 10)
+    data = rng.randint(0, 100, size=(len(tax_l), 3))
+
+    cache = TaxonomyCache(os.path.join(tempfile.mkdtemp(), 'memo.sqlite'))
+    result = collapse_table(tax_l, data, ['s1', 's2', 's3'])
+    result_sharded = collapse_table(tax_l, data, ['s1', 's2', 's3'], num_workers=3, min_shard_records=50, cache=cache)
+
+    assert result_sharded.records == tax_l
+    assert np.array_equal(result_sharded.membership.toarray(), result.membership.toarray())
+    assert np.allclose(result_sharded.collapsed_df.values, result.collapsed_df.values)
+    assert len(cache) == len(set(tax if tax is not None else '' for tax in tax_l)) # parent stored all matches
+
+    # shards cover only distinct taxonomies not in the memo
+    uniq_l = sorted(set(tax for tax in tax_l if tax is not None))
+    membership_uniq = assign_groups(db, uniq_l)
+    assert np.array_equal(assign_groups(db, uniq_l, num_workers=3, min_shard_records=50), membership_uniq)
+    assert np.array_equal(
+        assign_groups(db, uniq_l, cache=cache, num_workers=3, min_shard_records=50), membership_uniq) # all cached
+
+    # filtered, and too few taxonomies to shard
+    result_N = collapse_table(tax_l, data, ['s1', 's2', 's3'], group_filter={'elements': 'N'})
+    result_N_sharded = collapse_table(
+        tax_l, data, ['s1', 's2', 's3'], group_filter={'elements': 'N'}, num_workers=2, min_shard_records=50)
+    assert result_N_sharded.get_groups_l() == result_N.get_groups_l()
+    assert collapse_table(tax_l, data, ['s1', 's2', 's3'], num_workers=8).get_groups_l() == result.get_groups_l()
+
+    # sample blocks, serial and sharded
+    for num_workers in [1, 3]:
+        result_blocked = collapse_table(
+            tax_l, data, ['s1', 's2', 's3'], num_workers=num_workers, min_shard_records=50, sample_block_size=2)
+        assert result_blocked.collapsed_df.equals(result.collapsed_df)
+
+
+####################################################################################################
+####################################################################################################
+def test_get_num_workers():
+    def write_cgroup(flnm2txt):
+        cgroup_dir = tempfile.mkdtemp()
+        for flnm, txt in flnm2txt.items():
+            os.makedirs(os.path.dirname(os.path.join(cgroup_dir, flnm)), exist_ok=True)
+            with open(os.path.join(cgroup_dir, flnm), 'w') as fh:
+                fh.write(txt)
+        return cgroup_dir
+
+    assert get_cgroup_cpu_quota(write_cgroup({'cpu.max': '200000 100000\n'})) == 2
+    assert get_cgroup_cpu_quota(write_cgroup({'cpu.max': 'max 100000\n'})) is None
+    assert get_cgroup_cpu_quota(write_cgroup({
+        'cpu,cpuacct/cpu.cfs_quota_us': '150000\n', 'cpu,cpuacct/cpu.cfs_period_us': '100000\n'})) == 1.5
+    assert get_cgroup_cpu_quota(write_cgroup({
+        'cpu/cpu.cfs_quota_us': '-1\n', 'cpu/cpu.cfs_period_us': '100000\n'})) is None
+    assert get_cgroup_cpu_quota(write_cgroup({})) is None
+
+    # capped by quota, at least 1
+    with patch('kb_faprotax.util.engine.get_cgroup_cpu_quota', return_value=0.5):
+        assert get_num_workers() == 1
+    with patch('kb_faprotax.util.engine.get_cgroup_cpu_quota', return_value=None):
+        assert get_num_workers() >= 1
@@ -43,6 +43,40 @@ def test_AmpliconMatrix_methods():
 
     assert np.allclose(data1, data2) and np.allclose(data2, data1) 
 
+####################################################################################################
+####################################################################################################
+def test_iter_OTU_table():
+    '''
+    Streamed OTU table should be the same text as the DataFrame's TSV
+    '''
+    obj = {
+        'data': {
+            'row_ids': ['r0', 'r1', 'r2', 'r3', 'r4'], 
+            'col_ids': ['s0', 's1', 's2'], 
+            'values': [[1, 2.5, None], [0, 0, 0], [None, None, None], [1e-7, 123456789, 3], [4, 5, 6]],
+        },
+    }
+    tax_l = ['A;B', None, 'A;B;C', 'D', 'E;F']
+
+    mock_dfu = Mock(get_objects=Mock(return_value={'data': [{'info': [0, 'name'], 'data': obj}]}))
+
+    with patch.dict('kb_faprotax.util.kbase_obj.Var', values={'dfu': mock_dfu}):
+        amp_mat = AmpliconMatrix('4/5/6')
+
+    txt = amp_mat.to_OTU_table(tax_l).to_csv(sep='\t')
+    assert ''.join(amp_mat.iter_OTU_table(tax_l)) == txt
+
+    # one row per block, ragged last block
+    for chunk_size in [1, 2, 3]:
+        assert ''.join(amp_mat.iter_OTU_table(tax_l, chunk_size=chunk_size)) == txt
+
+    # written file is byte-identical to the DataFrame's
+    flpth0, flpth1 = [os.path.join(tempfile.mkdtemp(), 'otu_table.tsv') for _ in range(2)]
+    amp_mat.to_OTU_table(tax_l, flpth=flpth0)
+    amp_mat.write_OTU_table(tax_l, flpth1, chunk_size=2)
+    with open(flpth0, 'rb') as fh0, open(flpth1, 'rb') as fh1:
+        assert fh0.read() == fh1.read()
+
 ####################################################################################################
 ####################################################################################################
 def test_AttributeMapping_methods():
@@ -84,6 +118,21 @@ def test_AttributeMapping_methods():
     assert row_attr_map.get_attributes_at(0) == row_attr_map_orig.get_attributes_at(0)
     assert row_attr_map.get_attributes_at(1) == row_attr_map_orig.get_attributes_at(1)
 
+    # columns convert back to the workspace dict-of-lists at save
+    instances = row_attr_map._to_instances()
+    assert list(instances) == row_attr_map.ids
+    assert all(len(instance) == row_attr_map.attributes_length for instance in instances.values())
+    assert instances['amplicon_id_5'][ind0] == 'green' and instances['amplicon_id_5'][ind1] == 'quasar'
+    assert instances['amplicon_id_0'][ind0] is None
+
+    # scatter attributes in AmpliconMatrix row order
+    ind2, _ = row_attr_map.add_attribute_slot('row order', 'unit testing')
+    row_ids = amp_mat.obj['data']['row_ids']
+    row_attr_map.update_attribute(ind2, ['attr_' + id for id in row_ids])
+    row_attr_map._check_attr_consistent(
+        ind2, 'row order', 'unit testing', 
+        {amp_mat.obj['row_mapping'][id]: 'attr_' + id for id in row_ids})
+
 ####################################################################################################
 ####################################################################################################
 def test_AmpliconMatrix_validation():
@@ -144,6 +193,15 @@ def test_AmpliconMatrix_validation():
     amp_mat.obj['data']['values'] = [None, -1]
     with raises(ValidationException, match='[Nn]egative'): amp_mat.validate_amplicon_abundance_data()
 
+    # converted once, cached until `values` is reassigned
+    amp_mat.obj['data']['values'] = [[None, 2], [3, 4]]
+    a = amp_mat.get_values()
+    assert a.dtype == float and a.flags['C_CONTIGUOUS'] and np.isnan(a[0, 0])
+    amp_mat.validate_amplicon_abundance_data()
+    assert amp_mat.get_values() is a
+    amp_mat.obj['data']['values'] = [[1, 2], [3, 4]]
+    assert amp_mat.get_values() is not a
+
     amp_mat.obj['data']['values'] = [None, None, 1.00001]
     with raises(ValidationException, match='[Ii]nteger'): amp_mat.validate_amplicon_abundance_data()
 
@@ -171,3 +229,4 @@ def test_GenomeSet_methods():
 ####################################################################################################
 def test_Genome_methods():
     pass
+
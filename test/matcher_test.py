@@ -0,0 +1,51 @@
+import random
+
+from kb_faprotax.util.database import FaprotaxDB
+from kb_faprotax.util.matcher import TaxonMatcher, compile_member
+from mock import * # mock business
+
+
+####################################################################################################
+####################################################################################################
+def test_TaxonMatcher_mock():
+    db = FaprotaxDB.compile(write_mock_db())
+    matcher = TaxonMatcher(db)
+
+    record = 'Bacteria;Proteobacteria;Deltaproteobacteria;Desulfovibrionales;Desulfovibrio'
+    assert [db.patterns[p] for p in matcher.match_patterns(record)] == [
+        '*Proteobacteria*', '*Deltaproteobacteria*', '*Deltaproteobacteria*Desulfovibrio*']
+    assert [db.group_names[i] for i in matcher.match_groups(record)] == [
+        'aerobic', 'anaerobic', 'obligate_aerobic_and_others']
+
+    assert matcher.match_groups('bacteria;NITROSPIRAE;Nitrospira') == [0, 1, 3, 4]
+    assert matcher.match_groups('Bacteria;Firmicutes') == []
+    assert matcher.match_groups(None) == []
+
+    # anchored, i.e. no leading `*`
+    db = FaprotaxDB.compile(write_mock_db('g\nBacteroides*thetaiotaomicron*\n\nh\n*she*\n*ushe*\n*hers*\n'))
+    matcher = TaxonMatcher(db)
+    assert matcher.match_groups('Bacteroides;Bacteroides thetaiotaomicron') == [0]
+    assert matcher.match_groups('Bacteria;Bacteroides;Bacteroides thetaiotaomicron') == []
+    assert matcher.match_patterns('ushers') == [1, 2, 3] # overlapping key tokens
+
+
+####################################################################################################
+####################################################################################################
+def test_TaxonMatcher_against_regex():
+    '''
+    Compare to brute-force matching every pattern on records built from the shipped database's tokens
+    '''
+    db = FaprotaxDB.compile(Var.db_flpth)
+    matcher = TaxonMatcher(db)
+    regexes = [compile_member(pattern) for pattern in db.patterns]
+
+    rng = random.Random(0)
+    tokens = [token for token in db.tokens if token]
+    records = [
+        ';'.join(rng.choice(tokens).capitalize() for _ in range(rng.randint(1, 7)))
+        for _ in range(300)
+    ] + get_pattern_records(db, rng.sample(range(len(db.patterns)), 300), extra=[])
+
+    for record in records:
+        assert matcher.match_patterns(record) == [
+            p for p, regex in enumerate(regexes) if regex.match(record)], record
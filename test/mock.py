@@ -1,6 +1,7 @@
 from unittest.mock import patch, create_autospec, Mock
 import os
 from shutil import rmtree, copytree
+import tempfile
 import logging
 import json
 
@@ -157,8 +158,12 @@ def get_mock_run_check(dataset):
     mock_run_check = create_autospec(run_check)
 
     # side effect
-    def mock_run_check_(cmd):
+    def mock_run_check_(cmd, stdin_chunks=None):
         logging.info('Mocking running cmd `%s`' % cmd)
+
+        if stdin_chunks is not None: # drain as the tool would
+            for chunk in stdin_chunks:
+                pass
        
         rmtree(Var.return_dir)
         copytree(os.path.join(testData_dir, 'by_dataset_input', dataset, 'return'), Var.return_dir)
@@ -167,3 +172,52 @@ def get_mock_run_check(dataset):
 
     return mock_run_check
 
+
+
+#####
+#####
+#####
+mock_db_txt = '''\
+# comment
+# comment
+
+nitrification	elements:N; aerobic:yes
+# - - - - - - - -
+*Proteobacteria*Nitrosomonas*	# ref
+*Nitrospira*
+"*Nitrobacter*"
+
+aerobic	aerobic:yes
+*Proteobacteria*
+*Nitrospira*
+
+anaerobic	aerobic:no
+*Deltaproteobacteria*
+
+obligate_aerobic_and_others
+add_group:aerobic
+subtract_group:anaerobic
+*Deltaproteobacteria*Desulfovibrio*
+
+aerobic_nitrifiers
+add_group:nitrification
+intersect_group:aerobic
+'''
+
+def write_mock_db(txt=mock_db_txt):
+    '''
+    Write small FAPROTAX.txt-format database exercising comments, quotes and set operations
+    '''
+    flpth = os.path.join(tempfile.mkdtemp(), 'FAPROTAX.txt')
+    with open(flpth, 'w') as fh:
+        fh.write(txt)
+    return flpth
+
+
+def get_pattern_records(db, inds, extra=(None, 'Bacteria;Firmicutes')) -> list:
+    '''
+    Taxonomies made from the database's patterns at `inds`, so each matches at least its own pattern,
+    e.g. `*Proteobacteria*Nitrosomonas*` -> `Proteobacteria;Nitrosomonas`,
+    followed by `extra` records, by default a missing taxonomy and a mostly unassigned one
+    '''
+    return [db.patterns[p].strip('*').replace('*', ';') for p in inds] + list(extra)
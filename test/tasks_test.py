@@ -0,0 +1,56 @@
+import threading
+from pytest import raises
+
+from kb_faprotax.util.tasks import run_tasks
+from mock import * # mock business
+
+
+####################################################################################################
+####################################################################################################
+def test_run_tasks():
+    order = []
+    started = {}
+    barrier = threading.Barrier(2, timeout=5) # `b` and `c` must overlap
+
+    def task(name, wait=False):
+        def func(*args):
+            started[name] = args
+            if wait:
+                barrier.wait()
+            order.append(name)
+            return name.upper()
+        return func
+
+    results = run_tasks({
+        'd': (task('d'), ['b', 'c']),
+        'a': (task('a'), []),
+        'b': (task('b', wait=True), ['a']),
+        'c': (task('c', wait=True), ['a']),
+    })
+
+    assert results == {'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}
+    assert order[0] == 'a' and order[-1] == 'd'
+    assert started['d'] == ('B', 'C') # dependency results, in order
+    assert started['b'] == ('A',)
+
+
+####################################################################################################
+####################################################################################################
+def test_run_tasks_fail():
+    ran = []
+
+    def fail():
+        raise ValueError('remote call failed')
+
+    with raises(ValueError, match='remote call failed'):
+        run_tasks({
+            'fail': (fail, []),
+            'after': (lambda _: ran.append('after'), ['fail']),
+        })
+    assert ran == []
+
+    with raises(Exception, match='unknown task'):
+        run_tasks({'a': (lambda _: None, ['nonexistent'])})
+
+    with raises(Exception, match='circular'):
+        run_tasks({'a': (lambda _: None, ['b']), 'b': (lambda _: None, ['a'])})
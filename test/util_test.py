@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from pytest import raises
 
 from kb_faprotax.kb_faprotaxImpl import kb_faprotax
@@ -8,7 +9,7 @@ from installed_clients.WorkspaceClient import Workspace
 from kb_faprotax.util.dprint import dprint, where_am_i
 from kb_faprotax.util.file import get_numbered_duplicate
 from kb_faprotax.util.error import NonZeroReturnException
-from kb_faprotax.util.workflow import run_check
+from kb_faprotax.util.workflow import run_check, get_prefetched, drop_prefetched
 from mock import * # mock business
 from upa import * # upa library
 import config
@@ -27,6 +28,14 @@ def test_run_check():
 
     run_check('set -o pipefail && echo hi |& tee tmp') # run correctly
 
+    # stream stdin
+    run_check('set -o pipefail && cat /dev/stdin > tmp', stdin_chunks=('line %d\n' % i for i in range(5000)))
+    with open('tmp') as fh:
+        assert fh.read() == ''.join('line %d\n' % i for i in range(5000))
+
+    with raises(NonZeroReturnException, match='`1`'): # exits without reading stdin
+        run_check('exit 1', stdin_chunks=('x' * 100000 for i in range(100)))
+
 
 ####################################################################################################
 ####################################################################################################
@@ -54,3 +63,36 @@ def test_get_numbered_duplicate():
     assert get_numbered_duplicate(names, q) == q + ' (1)'                                       
                                                                                                 
    
+
+####################################################################################################
+####################################################################################################
+def test_get_prefetched():
+    def fail():
+        raise Exception('remote call failed')
+
+    with ThreadPoolExecutor() as executor, patch.dict('kb_faprotax.util.workflow.Var', values={
+            'prefetch': {
+                'a': (executor.submit(lambda: 'A'), ('upa',)),
+                'b': (executor.submit(lambda: 'B'), ('other_upa',)),
+                'c': (executor.submit(fail), ()),
+            }}):
+        assert get_prefetched('a', 'upa') == 'A'
+        assert get_prefetched('a', 'upa') is None # joined once
+        assert get_prefetched('b', 'upa') is None # started with different args
+        assert get_prefetched('c') is None # failed, redo
+        assert get_prefetched('d') is None # never started
+
+
+def test_drop_prefetched():
+    def fail():
+        raise Exception('remote call failed')
+
+    with ThreadPoolExecutor() as executor, patch.dict('kb_faprotax.util.workflow.Var', values={
+            'prefetch': {
+                'a': (executor.submit(fail), ('upa',)),
+            }}):
+        future = Var.prefetch['a'][0]
+        drop_prefetched('a') # joined, failure logged not raised
+        assert future.done()
+        assert 'a' not in Var.prefetch
+        drop_prefetched('a') # already dropped
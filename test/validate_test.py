@@ -0,0 +1,32 @@
+import numpy as np
+
+from kb_faprotax.util.validate import Validate as vd, MISSING_VALS
+from mock import * # mock business
+
+
+####################################################################################################
+####################################################################################################
+def test_get_missing_mask():
+    a = np.array([1, None, '', 'None', np.nan, float('nan'), 'x', 0.0, 2], dtype=object)
+    assert vd.get_missing_mask(a).tolist() == [False, True, True, True, True, True, False, False, False]
+    assert vd.get_num_missing(a) == 5
+
+    a = np.array([[1.0, np.nan], [np.nan, 3.0]]) # numeric fast path
+    assert vd.get_missing_mask(a).tolist() == [[False, True], [True, False]]
+    assert vd.get_num_missing(a) == 2
+
+    assert vd.get_num_missing(np.array([[1, 2], [3, 4]])) == 0
+    assert vd.get_num_missing(np.array(['a', '', 'None'])) == 2
+    assert vd.get_num_missing(np.array([], dtype=object)) == 0
+    assert vd.get_num_missing(np.array(MISSING_VALS, dtype=object)) == len(MISSING_VALS)
+
+
+####################################################################################################
+####################################################################################################
+def test_replace_missing():
+    a = np.array([[1, None], ['', 4]], dtype=object)
+    a = vd.as_numeric(a)
+    assert a.dtype == float
+    assert np.array_equal(a, np.array([[1, np.nan], [np.nan, 4]]), equal_nan=True)
+
+    assert vd.as_numeric(np.array(['a', None], dtype=object)) is None